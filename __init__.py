@@ -5,14 +5,27 @@ from trytond.pool import Pool
 from . import electronic_mail_wizard
 from . import template
 from . import action
+from . import attachment
+from . import send
 
 
 def register():
     Pool.register(
         electronic_mail_wizard.TemplateEmailStart,
+        electronic_mail_wizard.TemplateEmailPreview,
+        electronic_mail_wizard.TemplateEmailPreviewLine,
         electronic_mail_wizard.TemplateEmailResult,
         electronic_mail_wizard.TemplateEmailAttachment,
         action.ActionWizard,
+        attachment.StoredAttachment,
+        attachment.ElectronicMailStoredAttachment,
+        attachment.ElectronicMail,
+        send.TemplateEmailSend,
+        send.TemplateEmailSendAttachment,
+        send.TemplateEmailSendFailure,
+        send.TemplateEmailSendRecord,
+        send.TemplateEmailSendStatistics,
+        send.TemplateEmailSendDigest,
         template.Template,
         module='electronic_mail_wizard', type_='model')
     Pool.register(
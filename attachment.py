@@ -0,0 +1,193 @@
+# This file is part electronic_mail_wizard module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import mimetypes
+from email import encoders, message_from_bytes, message_from_string
+from email.mime.base import MIMEBase
+
+from trytond.model import ModelSQL, fields, Unique
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction, without_check_access
+
+from .smtp import pooled_smtp
+
+__all__ = ['StoredAttachment', 'ElectronicMailStoredAttachment',
+    'ElectronicMail']
+
+# access-type of the message/external-body parts that reference an
+# attachment of the store
+ACCESS_TYPE = 'x-tryton-filestore'
+
+
+def attachment_part(name, data):
+    '''Return the base64 encoded MIME part of the attachment
+    The part is built once and can be attached to several messages as its
+    payload is an immutable string.
+    '''
+    content_type, _ = mimetypes.guess_type(name or '')
+    maintype, subtype = (content_type or 'application/octet-stream').split(
+        '/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(bytes(data))
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename=name)
+    return part
+
+
+def get_attachment_sizes(ids):
+    '''Return the size of the data of the ir.attachment ids
+    The sizes are read from the filestore without loading the data.
+    '''
+    Attachment = Pool().get('ir.attachment')
+    with Transaction().set_context(**{'ir.attachment.data': 'size'}):
+        return {a['id']: a['data'] or 0
+            for a in Attachment.read(list(ids), ['data'])}
+
+
+def stored_attachment_part(name, digest):
+    'Return the MIME part that references the stored attachment'
+    part = MIMEBase('message', 'external-body', **{
+            'access-type': ACCESS_TYPE,
+            'digest': digest,
+            })
+    part.set_payload('')
+    part.add_header('Content-Disposition', 'attachment', filename=name)
+    return part
+
+
+class StoredAttachment(ModelSQL):
+    'Electronic Mail Stored Attachment'
+    __name__ = 'electronic.mail.stored_attachment'
+
+    digest = fields.Char('Digest', required=True, readonly=True,
+        help='SHA-256 of the data.')
+    size = fields.Integer('Size', readonly=True)
+    data = fields.Binary('Data', file_id='file_id')
+    file_id = fields.Char('File ID', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StoredAttachment, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('digest_uniq', Unique(t, t.digest),
+                'electronic_mail_wizard.msg_stored_attachment_digest_unique'),
+            ]
+
+    @classmethod
+    @without_check_access
+    def get_or_create(cls, data):
+        '''Return the stored attachment of the data
+        The data is stored only once for all the mails that share it.
+        '''
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        attachments = cls.search([('digest', '=', digest)], limit=1)
+        if attachments:
+            attachment, = attachments
+        else:
+            attachment, = cls.create([{
+                        'digest': digest,
+                        'size': len(data),
+                        'data': data,
+                        }])
+        return attachment
+
+    @classmethod
+    @without_check_access
+    def delete_unused(cls, ids):
+        '''Delete the attachments of ids no longer referenced
+        The attachments are shared by the mails so they are deleted whatever
+        the access of the user deleting the mails.
+        '''
+        pool = Pool()
+        MailAttachment = pool.get(
+            'electronic.mail-electronic.mail.stored_attachment')
+        SendAttachment = pool.get('electronic.mail.wizard.send.attachment')
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            used = set()
+            for Relation in [MailAttachment, SendAttachment]:
+                used.update(r.attachment.id for r in Relation.search([
+                            ('attachment', 'in', sub_ids),
+                            ]))
+            unused = [i for i in sub_ids if i not in used]
+            if unused:
+                cls.delete(cls.browse(unused))
+
+
+class ElectronicMailStoredAttachment(ModelSQL):
+    'Electronic Mail - Stored Attachment'
+    __name__ = 'electronic.mail-electronic.mail.stored_attachment'
+
+    mail = fields.Many2One('electronic.mail', 'Mail', required=True,
+        ondelete='CASCADE')
+    attachment = fields.Many2One('electronic.mail.stored_attachment',
+        'Attachment', required=True, ondelete='RESTRICT')
+
+
+class ElectronicMail(metaclass=PoolMeta):
+    __name__ = 'electronic.mail'
+    stored_attachments = fields.Many2Many(
+        'electronic.mail-electronic.mail.stored_attachment', 'mail',
+        'attachment', 'Stored Attachments', readonly=True)
+
+    @classmethod
+    def _send_mail(cls, mails):
+        # the mails of a mailbox are sent one after the other through the
+        # same SMTP connections
+        mails = sorted(mails, key=lambda m: m.mailbox.id if m.mailbox else 0)
+        # the attachments of the store are only assembled in the message
+        # given to the SMTP connection so the database keeps a single copy
+        # of them
+        with pooled_smtp(prepare=cls.expand_stored_attachments):
+            return super(ElectronicMail, cls)._send_mail(mails)
+
+    @classmethod
+    def expand_stored_attachments(cls, message):
+        '''Return the message with the stored attachments parts filled
+        :param message: email.message.Message, bytes or str
+        '''
+        if isinstance(message, bytes):
+            if ACCESS_TYPE.encode() not in message:
+                return message
+            return cls.expand_stored_attachments(
+                message_from_bytes(message)).as_bytes()
+        elif isinstance(message, str):
+            if ACCESS_TYPE not in message:
+                return message
+            return cls.expand_stored_attachments(
+                message_from_string(message)).as_string()
+
+        StoredAttachment = Pool().get('electronic.mail.stored_attachment')
+        references = []
+        for container in message.walk():
+            if not container.is_multipart():
+                continue
+            parts = container.get_payload()
+            for i, part in enumerate(parts):
+                if (part.get_content_type() == 'message/external-body'
+                        and part.get_param('access-type') == ACCESS_TYPE):
+                    references.append((parts, i, part))
+        if not references:
+            return message
+        attachments = {a.digest: a for a in StoredAttachment.search([
+                    ('digest', 'in', list({p.get_param('digest')
+                                for _, _, p in references})),
+                    ])}
+        for parts, i, part in references:
+            attachment = attachments.get(part.get_param('digest'))
+            if attachment:
+                parts[i] = attachment_part(part.get_filename(),
+                    attachment.data)
+        return message
+
+    @classmethod
+    def delete(cls, mails):
+        pool = Pool()
+        StoredAttachment = pool.get('electronic.mail.stored_attachment')
+        attachment_ids = {a.id for m in mails for a in m.stored_attachments}
+        super(ElectronicMail, cls).delete(mails)
+        StoredAttachment.delete_unused(attachment_ids)
@@ -1,21 +1,55 @@
 # This file is part electronic_mail_wizard module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import time
+from email.header import decode_header, make_header
+
+from trytond.cache import Cache
 from trytond.config import config
 from trytond.model import ModelView, fields
 from trytond.pool import Pool
-from trytond.pyson import Eval
-from trytond.tools import grouped_slice
-from trytond.transaction import Transaction
-from trytond.wizard import Wizard, StateTransition, StateView, Button
+from trytond.pyson import Eval, PYSONEncoder
+from trytond.transaction import Transaction, check_access
+from trytond.wizard import (Wizard, StateTransition, StateView, StateAction,
+    Button)
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 
+from .attachment import get_attachment_sizes
+from .send import SEND_FIELDS, without_active_records
+
 
-# Determines max connections to database used for the mail send thread
-MAX_DB_CONNECTION = config.getint('database', 'max_connections', default=50)
 MAX_ATTACHMENT_SIZE = config.getint('email', 'max_attachment_size',
     default=26214400)
+# Maximum size of all the attachments of a send
+MAX_ATTACHMENTS_SIZE = config.getint('email', 'max_attachments_size',
+    default=MAX_ATTACHMENT_SIZE)
+STORE_ATTACHMENTS = config.getboolean('email', 'store_attachments',
+    default=False)
+# Number of records rendered by the preview
+PREVIEW_SIZE = config.getint('email', 'wizard_preview_size', default=5)
+
+
+def header_value(message, name):
+    'Return the decoded value of the header of the email message'
+    value = message[name]
+    if value is None:
+        return None
+    return str(make_header(decode_header(str(value))))
+
+
+def message_body(message):
+    'Return the text body of the email message'
+    bodies = {}
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if (content_type in {'text/plain', 'text/html'}
+                and content_type not in bodies
+                and not part.get_filename()):
+            payload = part.get_payload(decode=True) or b''
+            bodies[content_type] = payload.decode(
+                part.get_content_charset() or 'utf-8', 'replace')
+    return bodies.get('text/plain') or bodies.get('text/html') or ''
 
 
 class TemplateEmailAttachment(ModelView):
@@ -25,12 +59,14 @@ class TemplateEmailAttachment(ModelView):
     name = fields.Char('Name')
     data = fields.Binary('Data', filename='name')
 
-    @fields.depends('data')
+    @fields.depends('name', 'data')
     def on_change_data(self):
-        size = len(self.data or '')
+        size = len(self.data or b'')
         if size and size >= MAX_ATTACHMENT_SIZE:
-            self.data = None
-            self.name = None
+            raise UserError(gettext(
+                    'electronic_mail_wizard.msg_attachment_too_big',
+                    names=self.name or '',
+                    size=MAX_ATTACHMENT_SIZE))
 
 
 class TemplateEmailStart(ModelView):
@@ -60,30 +96,117 @@ class TemplateEmailStart(ModelView):
     attachments = fields.One2Many(
         'electronic.mail.wizard.templateemail.attachment', None,
         'Attachments', help="Attchments from user computer.")
+    store_attachments = fields.Boolean('Store Attachments Once',
+        help='Store the attachments only once for all the emails and add '
+        'them to each email when it is sent.')
+    deduplicate = fields.Boolean('Deduplicate',
+        help='Send only one email when several records render the same '
+        'recipients and content.')
+    merge_attachments = fields.Boolean('Merge Attachments',
+        states={
+            'invisible': ~Eval('deduplicate', False),
+            },
+        help='Add the attachments of the deduplicated emails to the email '
+        'sent.')
+    background = fields.Boolean('Send in Background',
+        help='Generate the emails in background tasks and follow the '
+        'progress of the send.')
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        readonly=True)
     origin = fields.Reference('Origin', selection='get_origin')
+    _get_origin_cache = Cache(
+        'electronic.mail.wizard.templateemail.start.get_origin')
     origin_attachments = fields.Many2Many('ir.attachment', None, None,
         'Origin Attachments', domain=[
             ('resource', '=', Eval('origin', -1))
                 ])
+    origin_attachments_size = fields.Function(fields.Integer(
+            'Origin Attachments Size', readonly=True),
+        'on_change_with_origin_attachments_size')
 
     @staticmethod
     def default_use_tmpl_fields():
         return True
 
+    @staticmethod
+    def default_store_attachments():
+        return STORE_ATTACHMENTS
+
+    @staticmethod
+    def default_deduplicate():
+        return False
+
+    @staticmethod
+    def default_merge_attachments():
+        return False
+
+    @staticmethod
+    def default_background():
+        return False
+
+    @fields.depends('origin_attachments')
+    def on_change_with_origin_attachments_size(self, name=None):
+        # only the sizes are read from the filestore
+        return sum(get_attachment_sizes(
+                [a.id for a in self.origin_attachments or []]).values())
+
     @classmethod
     def _get_origin(cls):
         pool = Pool()
         Template = pool.get('electronic.mail.template')
-        templates = Template.search([])
-        return list(set([t.model.name for t in templates]))
+        Model = pool.get('ir.model')
+        template = Template.__table__()
+        model = Model.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*template.join(model,
+                condition=template.model == model.id
+                ).select(model.name, distinct=True))
+        return [m for m, in cursor]
 
     @classmethod
     def get_origin(cls):
         pool = Pool()
         Model = pool.get('ir.model')
+        key = Transaction().language
+        origins = cls._get_origin_cache.get(key)
+        if origins is not None:
+            return origins
         get_name = Model.get_name
         models = cls._get_origin()
-        return [(None, '')] + [(m, get_name(m)) for m in models]
+        origins = [(None, '')] + sorted(
+            ((m, get_name(m)) for m in models), key=lambda o: o[1])
+        cls._get_origin_cache.set(key, origins)
+        return origins
+
+
+class TemplateEmailPreview(ModelView):
+    'Template Email Preview'
+    __name__ = 'electronic.mail.wizard.templateemail.preview'
+
+    total = fields.Integer('Total', readonly=True,
+        help='Total emails to send')
+    previews = fields.One2Many(
+        'electronic.mail.wizard.templateemail.preview.line', None,
+        'Previews', readonly=True)
+    estimated_size = fields.Integer('Estimated Size', readonly=True,
+        help='Estimated size in bytes of all the emails to send')
+    estimated_time = fields.Float('Estimated Time', digits=(16, 2),
+        readonly=True,
+        help='Estimated time in seconds to render all the emails to send')
+
+
+class TemplateEmailPreviewLine(ModelView):
+    'Template Email Preview Line'
+    __name__ = 'electronic.mail.wizard.templateemail.preview.line'
+
+    record = fields.Char('Record', readonly=True)
+    to = fields.Char('To', readonly=True)
+    subject = fields.Char('Subject', readonly=True)
+    body = fields.Text('Body', readonly=True)
+    size = fields.Integer('Size', readonly=True,
+        help='Size in bytes of the email')
+    render_time = fields.Float('Render Time', digits=(16, 3), readonly=True,
+        help='Time in seconds to render the email')
 
 
 class TemplateEmailResult(ModelView):
@@ -100,20 +223,62 @@ class GenerateTemplateEmail(Wizard):
     start = StateView('electronic.mail.wizard.templateemail.start',
         'electronic_mail_wizard.templateemail_start', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Send', 'send', 'tryton-ok'),
+            Button('Preview', 'preview', 'tryton-print'),
+            Button('Send', 'send', 'tryton-ok', default=True),
+            ])
+    preview = StateView('electronic.mail.wizard.templateemail.preview',
+        'electronic_mail_wizard.templateemail_preview', [
+            Button('Back', 'start', 'tryton-back'),
+            Button('Send', 'send', 'tryton-ok', default=True),
             ])
     send = StateTransition()
+    open_send = StateAction('electronic_mail_wizard.act_send_form')
+
+    def get_domain(self):
+        '''Return the domain of the records to send or None to send the
+        active ids
+        The active domain is a context key of the RPC API, the client sends
+        only the active ids. It is used only without active ids to select
+        all the records of a domain without sending their ids.
+        '''
+        context = Transaction().context
+        if context.get('active_ids'):
+            return None
+        return context.get('active_domain')
+
+    def get_ids(self, model, limit):
+        'Return the ids of the first records to send'
+        domain = self.get_domain()
+        if domain is None:
+            return Transaction().context.get('active_ids', [])[:limit]
+        Model = Pool().get(model)
+        # the wizard is executed without checking the access so the record
+        # rules of the user are enforced on the domain
+        with check_access():
+            return [r.id for r in Model.search(domain, order=[('id', 'ASC')],
+                    limit=limit)]
+
+    def get_total(self, model):
+        'Return the number of records to send'
+        domain = self.get_domain()
+        if domain is None:
+            return len(Transaction().context.get('active_ids', []))
+        with check_access():
+            return Pool().get(model).search_count(domain)
 
     def default_start(self, fields):
         pool = Pool()
         Wizard = pool.get('ir.action.wizard')
         context = Transaction().context
         active_ids = context.get('active_ids', [])
-        if not active_ids:
+        if not active_ids and self.get_domain() is None:
             return {}
+        # keep the values edited before going to the preview
+        if getattr(self.start, 'template', None):
+            return self.start._default_values
 
         default = self.render_fields(self.__name__)
-        if len(active_ids) >= 2:
+        if default['total'] != 1:
             default['use_tmpl_fields'] = True
         else:
             action_id = context.get('action_id', None)
@@ -124,18 +289,93 @@ class GenerateTemplateEmail(Wizard):
                     'electronic_mail_wizard.template_deleted'))
 
             default['use_tmpl_fields'] = False
-            default['origin'] = "%s,%s" % (template.model.name, active_ids[0])
+            record_id, = self.get_ids(template.model.name, 1)
+            default['origin'] = "%s,%s" % (template.model.name, record_id)
+        return default
+
+    def default_preview(self, fields):
+        '''Render the first records to preview the emails and estimate the
+        size and time of the whole send
+        '''
+        pool = Pool()
+        Send = pool.get('electronic.mail.wizard.send')
+        Template = pool.get('electronic.mail.template')
+
+        template = self.start.template
+        if not template:
+            raise UserError(gettext(
+                'electronic_mail_wizard.template_deleted'))
+        Model = pool.get(template.model.name)
+        total = self.get_total(template.model.name)
+
+        # the shared attachments are added to each email base64 encoded
+        attachments_size = sum(len(a.data or b'')
+            for a in self.start.attachments)
+        attachments_size += sum(get_attachment_sizes(
+                [a.id for a in self.start.origin_attachments]).values())
+        attachments_size = attachments_size * 4 // 3
+
+        send = Send(template=template,
+            **{n: getattr(self.start, n) for n in SEND_FIELDS})
+        previews = []
+        sample = self.get_ids(template.model.name, PREVIEW_SIZE)
+        for language, ids in send.group_by_language(sample).items():
+            with Transaction().set_context(language=language):
+                template = Template(template.id)
+                values = send.get_values(template)
+                for record in Model.browse(ids):
+                    start = time.monotonic()
+                    messages, failures = send.render_mails(template,
+                        [record], values)
+                    render_time = time.monotonic() - start
+                    if failures:
+                        (_, error), = failures
+                        previews.append({
+                                'record': record.rec_name,
+                                'body': error,
+                                'render_time': render_time,
+                                })
+                        continue
+                    (_, mail_message), = messages
+                    previews.append({
+                            'record': record.rec_name,
+                            'to': header_value(mail_message, 'to'),
+                            'subject': header_value(mail_message, 'subject'),
+                            'body': message_body(mail_message),
+                            'size': (len(mail_message.as_bytes())
+                                + attachments_size),
+                            'render_time': render_time,
+                            })
+        default = {
+            'total': total,
+            'previews': previews,
+            }
+        if previews:
+            default['estimated_size'] = int(total
+                * sum(p.get('size', 0) for p in previews) / len(previews))
+            default['estimated_time'] = (total
+                * sum(p['render_time'] for p in previews) / len(previews))
         return default
 
     def transition_send(self):
         context = Transaction().context
         active_ids = context.get('active_ids', [])
-        if not active_ids:
+        if not active_ids and self.get_domain() is None:
             return 'end'
 
-        self.render_and_send()
+        send = self.render_and_send()
+        if self.start.background:
+            self.start.send = send
+            return 'open_send'
         return 'end'
 
+    def do_open_send(self, action):
+        action['domain'] = PYSONEncoder().encode([
+                ('id', '=', self.start.send.id),
+                ])
+        action['views'].reverse()
+        return action, {}
+
     def render_fields(self, name):
         '''Get the fields before render and return a dicc
         :param name: Str ir.action.wizard
@@ -146,16 +386,21 @@ class GenerateTemplateEmail(Wizard):
         Template = pool.get('electronic.mail.template')
 
         context = Transaction().context
-        active_ids = context.get('active_ids')
         action_id = context.get('action_id', None)
         wizard = Wizard(action_id)
         template = wizard.template[0] if wizard.template else None
         if not template:
             raise UserError(gettext(
                 'electronic_mail_wizard.template_deleted'))
-        total = len(active_ids)
-
-        record = pool.get(template.model.name)(active_ids[0])
+        total = self.get_total(template.model.name)
+        if not total:
+            return {
+                'template': template.id,
+                'total': total,
+                }
+
+        record_id, = self.get_ids(template.model.name, 1)
+        record = pool.get(template.model.name)(record_id)
         # load data in language when send a record
         if template.language:
             language = template.eval(template.language, record)
@@ -186,7 +431,7 @@ class GenerateTemplateEmail(Wizard):
                 default['markdown'] = template.markdown
             else:
                 # Show fields with rendered tags and using template's language
-                record = pool.get(template.model.name)(active_ids[0])
+                record = pool.get(template.model.name)(record_id)
                 default['from_'] = template.eval(template.from_, record)
                 default['message_id'] = template.eval(template.message_id, record)
                 if template.in_reply_to:
@@ -206,29 +451,55 @@ class GenerateTemplateEmail(Wizard):
                 default['markdown'] = template.eval(template.markdown, record)
         return default
 
-    def render_and_send(self):
-        pool = Pool()
-        Template = pool.get('electronic.mail.template')
-        ElectronicEmail = pool.get('electronic.mail')
-
-        template = self.start.template
-        if not template:
+    def check_attachments(self):
+        'Check the size of the attachments without loading the stored ones'
+        oversized = [a.name for a in self.start.attachments
+            if len(a.data or b'') >= MAX_ATTACHMENT_SIZE]
+        sizes = get_attachment_sizes(
+            [a.id for a in self.start.origin_attachments])
+        oversized.extend(a.name for a in self.start.origin_attachments
+            if sizes.get(a.id, 0) >= MAX_ATTACHMENT_SIZE)
+        if oversized:
             raise UserError(gettext(
-                'electronic_mail_wizard.template_deleted'))
+                    'electronic_mail_wizard.msg_attachment_too_big',
+                    names=', '.join(oversized),
+                    size=MAX_ATTACHMENT_SIZE))
+        size = (sum(len(a.data or b'') for a in self.start.attachments)
+            + sum(sizes.values()))
+        if size > MAX_ATTACHMENTS_SIZE:
+            raise UserError(gettext(
+                    'electronic_mail_wizard.msg_attachments_too_big',
+                    size=size,
+                    max_size=MAX_ATTACHMENTS_SIZE))
 
-        records = Transaction().context.get('active_ids')
-        for sub_records in grouped_slice(records, MAX_DB_CONNECTION):
-            for active_id in sub_records:
-                record = pool.get(template.model.name)(active_id)
-                # load data in language when send a record
-                if template.language:
-                    language = template.eval(template.language, record)
-                else:
-                    language = Transaction().context.get('language')
-
-                with Transaction().set_context(language=language):
-                    template = Template(template.id)
-                values = {
+    def create_send(self):
+        'Create the send with the values of the wizard'
+        pool = Pool()
+        Send = pool.get('electronic.mail.wizard.send')
+        StoredAttachment = pool.get('electronic.mail.stored_attachment')
+
+        attachments = []
+        for attachment in self.start.attachments:
+            if attachment.data:
+                attachments.append({
+                    'name': attachment.name,
+                    'attachment': StoredAttachment.get_or_create(
+                        attachment.data).id,
+                    })
+        # origin attachments are only referenced and read when processed
+        sizes = get_attachment_sizes(
+            [a.id for a in self.start.origin_attachments])
+        for attachment in self.start.origin_attachments:
+            if sizes.get(attachment.id):
+                attachments.append({
+                    'name': attachment.name,
+                    'origin_attachment': attachment.id,
+                    })
+        domain = self.get_domain()
+        send, = Send.create([{
+                    'template': self.start.template.id,
+                    'domain': (PYSONEncoder().encode(domain)
+                        if domain is not None else None),
                     'from_': self.start.from_,
                     'sender': self.start.sender,
                     'to': self.start.to,
@@ -237,37 +508,40 @@ class GenerateTemplateEmail(Wizard):
                     'message_id': self.start.message_id,
                     'in_reply_to': self.start.in_reply_to,
                     'references': self.start.references,
-                    'template': template.id,
-                    }
-                if self.start.use_tmpl_fields:
-                    tmpl_fields = ('subject', 'markdown')
-                    for field_name in tmpl_fields:
-                        values[field_name] = getattr(template, field_name)
-                else:
-                    values.update({
-                        'subject': self.start.subject,
-                        'markdown': self.start.markdown,
-                        })
-
-                attachments = []
-                for attachment in (self.start.attachments
-                        + self.start.origin_attachments):
-                    if attachment.data:
-                        attachments.append({
-                            'name': attachment.name,
-                            'data': attachment.data,
-                            })
+                    'use_tmpl_fields': self.start.use_tmpl_fields,
+                    'subject': self.start.subject,
+                    'markdown': self.start.markdown,
+                    'store_attachments': self.start.store_attachments,
+                    'deduplicate': self.start.deduplicate,
+                    'merge_attachments': self.start.merge_attachments,
+                    'language': Transaction().context.get('language'),
+                    'attachments': [('create', attachments)],
+                    'total': self.get_total(self.start.template.model.name),
+                    }])
+        return send
 
-                with Transaction().set_context(language=language):
-                    mail_message = Template.render(template, record, values,
-                        extra_attachments=attachments)
+    def render_and_send(self):
+        pool = Pool()
+        Send = pool.get('electronic.mail.wizard.send')
 
-                electronic_mail = ElectronicEmail.create_from_mail(mail_message,
-                    template.mailbox.id, record)
-                if not electronic_mail:
-                    continue
-                electronic_mail.template = template
-                electronic_mail.save()
+        template = self.start.template
+        if not template:
+            raise UserError(gettext(
+                'electronic_mail_wizard.template_deleted'))
 
-                # call send_mail button. _send_mail is the queue
-                ElectronicEmail.send_mail([electronic_mail])
+        self.check_attachments()
+        send = self.create_send()
+        if send.domain is not None:
+            # the ids are streamed from the domain when processed
+            if self.start.background:
+                with without_active_records():
+                    Send.__queue__.enqueue_domain([send])
+            else:
+                Send.process_domain([send])
+            return send
+        records = Transaction().context.get('active_ids')
+        if self.start.background:
+            send.enqueue(records)
+        else:
+            Send.process([send], records)
+        return send
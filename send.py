@@ -0,0 +1,961 @@
+# This file is part electronic_mail_wizard module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import logging
+import multiprocessing
+import time
+from collections import defaultdict, deque
+from collections.abc import Sized
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from email import message_from_bytes
+from email.utils import getaddresses
+from itertools import count, islice
+
+from sql import Conflict
+from sql.functions import CurrentTimestamp
+
+from trytond.cache import LRUDict
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval, PYSONDecoder
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, check_access
+
+from .attachment import (attachment_part, stored_attachment_part,
+    get_attachment_sizes)
+from .stats import LOG_LEVEL, SendStats, count_queries, profile
+
+__all__ = ['TemplateEmailSend', 'TemplateEmailSendAttachment',
+    'TemplateEmailSendFailure', 'TemplateEmailSendRecord',
+    'TemplateEmailSendStatistics', 'TemplateEmailSendDigest']
+
+logger = logging.getLogger(__name__)
+
+# Number of records rendered and stored by chunk
+BATCH_SIZE = config.getint('email', 'wizard_batch_size', default=50)
+# Commit the transaction after each chunk of a send processed in background
+COMMIT_CHUNKS = config.getboolean('email', 'wizard_commit_chunks',
+    default=True)
+# Number of ids read by page from the domain of a send and grouped by language
+PAGE_SIZE = config.getint('email', 'wizard_page_size', default=1000)
+# Number of processes used to render the emails of a send
+RENDER_PROCESSES = config.getint('email', 'wizard_processes', default=0)
+# Fields of the send needed to render the template
+SEND_FIELDS = ['from_', 'sender', 'to', 'cc', 'bcc', 'message_id',
+    'in_reply_to', 'references', 'use_tmpl_fields', 'subject', 'markdown',
+    'deduplicate', 'merge_attachments', 'language']
+
+# Keys of the context of the wizard that are not needed to process a send
+ACTIVE_KEYS = {'active_ids', 'active_id', 'active_domain'}
+# MIME parts of the attachments of the last sends processed so the chunk
+# tasks of a send read the attachments once per process
+_attachments_cache = LRUDict(1)
+# Seconds the MIME parts of the attachments of a send are kept
+ATTACHMENTS_CACHE_DURATION = 300
+
+
+def message_digests(message):
+    '''Return the digest of the recipients and content of the message and
+    the attachment parts by digest
+    '''
+    content = hashlib.sha256()
+    for name in ['to', 'cc', 'bcc']:
+        addresses = sorted(a.lower() for _, a in getaddresses(
+                    [str(v) for v in message.get_all(name, [])]))
+        content.update(('%s:%s\n' % (name, ','.join(addresses))).encode())
+    content.update(('subject:%s\n' % message.get('subject', '')).encode())
+    attachments = {}
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename():
+            attachments[hashlib.sha256(payload).hexdigest()] = part
+        else:
+            content.update(payload)
+    return content.hexdigest(), attachments
+
+
+def message_size(message):
+    'Return the size of the encoded payloads of the message'
+    return sum(len(part.get_payload()) for part in message.walk()
+        if not part.is_multipart())
+
+
+def iter_chunks(ids, size):
+    'Yield lists of at most size ids of the iterable without materializing it'
+    iterator = iter(ids)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextmanager
+def without_active_records():
+    '''Remove the active records of the wizard from the context
+    The context is stored with each queue task and pickled with each chunk
+    rendered in a process.
+    '''
+    transaction = Transaction()
+    context = {k: v for k, v in transaction.context.items()
+        if k not in ACTIVE_KEYS}
+    with transaction.reset_context(), transaction.set_context(context):
+        yield
+
+
+@contextmanager
+def savepoint():
+    '''Rollback the changes done inside the block when it fails without
+    rolling back the transaction
+    '''
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    name = 'electronic_mail_wizard_%s' % next(_savepoint_ids)
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        transaction.cache.clear()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+_savepoint_ids = count()
+
+
+def init_worker(sections):
+    'Load the configuration of the parent in the render process'
+    config.read_dict(sections)
+
+
+def render_worker(database_name, user, context, values, ids):
+    '''Render the template of the send values for the ids
+    :return: list of (language, list of (id, message bytes), failures)
+    '''
+    if database_name not in Pool.database_list():
+        with Transaction().start(database_name, 0, readonly=True):
+            Pool(database_name).init()
+    with Transaction().start(database_name, user, readonly=True,
+            context=context):
+        Send = Pool().get('electronic.mail.wizard.send')
+        send = Send(**values)
+        result = []
+        for template, messages, failures in send.render_chunks(ids):
+            result.append((Transaction().context.get('language'),
+                    [(r.id, m.as_bytes()) for r, m in messages], failures))
+        return result
+
+
+class TemplateEmailSend(ModelSQL, ModelView):
+    'Template Email Send'
+    __name__ = 'electronic.mail.wizard.send'
+
+    template = fields.Many2One('electronic.mail.template', 'Template',
+        required=True, readonly=True, ondelete='CASCADE')
+    domain = fields.Char('Domain', readonly=True,
+        help='The records to send when they are selected by a domain.')
+    from_ = fields.Char('From', readonly=True)
+    sender = fields.Char('Sender', readonly=True)
+    to = fields.Char('To', readonly=True)
+    cc = fields.Char('CC', readonly=True)
+    bcc = fields.Char('BCC', readonly=True)
+    message_id = fields.Char('Message-ID', readonly=True)
+    in_reply_to = fields.Char('In Repply To', readonly=True)
+    references = fields.Char('References', readonly=True)
+    use_tmpl_fields = fields.Boolean('Use template fields', readonly=True)
+    subject = fields.Char('Subject', readonly=True)
+    markdown = fields.Text('Markdown Body', readonly=True)
+    store_attachments = fields.Boolean('Store Attachments Once',
+        readonly=True)
+    deduplicate = fields.Boolean('Deduplicate', readonly=True)
+    merge_attachments = fields.Boolean('Merge Attachments', readonly=True)
+    language = fields.Char('Language', readonly=True,
+        help='The language of the user who sent the emails, used when the '
+        'template has no language.')
+    attachments = fields.One2Many('electronic.mail.wizard.send.attachment',
+        'send', 'Attachments', readonly=True)
+    failures = fields.One2Many('electronic.mail.wizard.send.failure',
+        'send', 'Failures', readonly=True)
+    total = fields.Integer('Total', readonly=True,
+        help='Total emails to send')
+    rendered = fields.Integer('Rendered', readonly=True,
+        help='Emails generated and queued to send')
+    failed = fields.Integer('Failed', readonly=True,
+        help='Emails that could not be generated')
+    merged = fields.Integer('Merged', readonly=True,
+        help='Emails merged into an identical email')
+    state = fields.Function(fields.Selection([
+                ('running', 'Running'),
+                ('done', 'Done'),
+                ], 'State'), 'get_state')
+    statistics = fields.Function(fields.Dict(None, 'Statistics'),
+        'get_statistics')
+    statistics_summary = fields.Function(fields.Text('Statistics'),
+        'get_statistics_summary')
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateEmailSend, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'retry_failed': {
+                    'invisible': Eval('failed', 0) == 0,
+                    'depends': ['failed'],
+                    },
+                })
+
+    @staticmethod
+    def default_total():
+        return 0
+
+    @staticmethod
+    def default_rendered():
+        return 0
+
+    @staticmethod
+    def default_failed():
+        return 0
+
+    @staticmethod
+    def default_merged():
+        return 0
+
+    def get_state(self, name):
+        if ((self.rendered or 0) + (self.failed or 0) + (self.merged or 0)
+                >= (self.total or 0)):
+            return 'done'
+        return 'running'
+
+    @classmethod
+    def get_statistics(cls, sends, name):
+        pool = Pool()
+        Statistics = pool.get('electronic.mail.wizard.send.statistics')
+        values = defaultdict(list)
+        for sub_ids in grouped_slice([s.id for s in sends]):
+            for statistics in Statistics.search([
+                        ('send', 'in', list(sub_ids)),
+                        ]):
+                values[statistics.send.id].append(statistics.statistics)
+        return {s.id: SendStats.merge(*values[s.id]) for s in sends}
+
+    def get_statistics_summary(self, name):
+        return SendStats.format(self.statistics)
+
+    def get_rec_name(self, name):
+        return '%s (%s)' % (self.template.rec_name, self.create_date)
+
+    def increment(self, rendered=0, failed=0, merged=0):
+        'Add the emails to the counters of the send'
+        # the counters are updated in SQL as the chunks of a send may be
+        # processed by concurrent queue tasks
+        transaction = Transaction()
+        table = self.__table__()
+        cursor = transaction.connection.cursor()
+        cursor.execute(*table.update(
+                [table.rendered, table.failed, table.merged],
+                [table.rendered + rendered, table.failed + failed,
+                    table.merged + merged],
+                where=table.id == self.id))
+        for cache in transaction.cache.values():
+            if self.__name__ in cache:
+                cache[self.__name__].pop(self.id, None)
+
+    @classmethod
+    @ModelView.button
+    def retry_failed(cls, sends):
+        'Send again only the records that failed'
+        pool = Pool()
+        Failure = pool.get('electronic.mail.wizard.send.failure')
+        for send in sends:
+            failures = send.failures
+            if not failures:
+                continue
+            ids = list({f.record_id for f in failures})
+            Failure.delete(failures)
+            send.unmark_processed(ids)
+            send.increment(failed=-len(failures))
+            send.enqueue(ids)
+
+    def enqueue(self, ids):
+        'Submit the ids to send as queue tasks of chunks'
+        with without_active_records():
+            for sub_ids in iter_chunks(ids, BATCH_SIZE):
+                self.__class__.__queue__.process(
+                    [self], sub_ids, commit=True)
+
+    @classmethod
+    def enqueue_domain(cls, sends):
+        'Submit the ids of the domain of the sends as queue tasks of chunks'
+        for send in sends:
+            send.enqueue(send.stream_ids())
+
+    def stream_ids(self):
+        '''Yield the ids of the records of the domain
+        The ids are read by pages of increasing ids so the memory does not
+        depend on the number of records and the pages are not shifted by
+        the records created or deleted meanwhile.
+        The record rules of the user who created the send are enforced as
+        the queue tasks are run without checking the access.
+        '''
+        pool = Pool()
+        Model = pool.get(self.template.model.name)
+        domain = PYSONDecoder().decode(self.domain) if self.domain else []
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        last_id = None
+        while True:
+            page_domain = [domain]
+            if last_id is not None:
+                page_domain.append(('id', '>', last_id))
+            with transaction.set_user(self.create_uid.id), check_access():
+                query = Model.search(page_domain, order=[('id', 'ASC')],
+                    limit=PAGE_SIZE, query=True)
+            cursor.execute(*query)
+            ids = [i for i, in cursor]
+            if not ids:
+                return
+            yield from ids
+            last_id = ids[-1]
+
+    def unprocessed_ids(self, ids):
+        '''Yield the ids not yet processed by the send
+        The queue runs again the tasks that fail after a chunk is committed
+        so the records of the committed chunks are not sent twice.
+        '''
+        pool = Pool()
+        Record = pool.get('electronic.mail.wizard.send.record')
+        table = Record.__table__()
+        cursor = Transaction().connection.cursor()
+        for page in iter_chunks(ids, PAGE_SIZE):
+            processed = set()
+            for sub_ids in grouped_slice(page):
+                cursor.execute(*table.select(table.record_id,
+                        where=(table.send == self.id)
+                        & reduce_ids(table.record_id, list(sub_ids))))
+                processed.update(i for i, in cursor)
+            for id_ in page:
+                if id_ not in processed:
+                    yield id_
+
+    def mark_processed(self, ids):
+        'Store the ids as processed by the send'
+        Record = Pool().get('electronic.mail.wizard.send.record')
+        if ids:
+            Record.create([{
+                        'send': self.id,
+                        'record_id': id_,
+                        } for id_ in ids])
+
+    def unmark_processed(self, ids):
+        'Remove the ids from the records processed by the send'
+        Record = Pool().get('electronic.mail.wizard.send.record')
+        table = Record.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.delete(
+                    where=(table.send == self.id)
+                    & reduce_ids(table.record_id, list(sub_ids))))
+
+    @classmethod
+    def process(cls, sends, ids, commit=False):
+        '''Render and send the emails of the records
+        :param commit: commit the transaction after each chunk, only the
+            queue tasks commit so the caller keeps the send atomic
+        '''
+        for send in sends:
+            with profile('electronic_mail_wizard-send-%s' % send.id):
+                send._process(ids, commit=commit)
+
+    @classmethod
+    def process_domain(cls, sends, commit=False):
+        'Render and send the emails of the records of the domain of the sends'
+        for send in sends:
+            with profile('electronic_mail_wizard-send-%s' % send.id):
+                send._process(send.stream_ids(), commit=commit)
+
+    def _process(self, ids, commit=False):
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Failure = pool.get('electronic.mail.wizard.send.failure')
+
+        # the attachments are the same for all the records so they are
+        # encoded once and their parts reused by every message
+        attachments, stored_attachments = self.get_attachments()
+        attachments_size = sum(message_size(p) for p in attachments)
+
+        transaction = Transaction()
+        commit = commit and COMMIT_CHUNKS
+        start = time.monotonic()
+        rendered = failed = merged = 0
+        with count_queries() as counter:
+            stats = SendStats(counter)
+            parallel = (RENDER_PROCESSES > 1
+                and (not isinstance(ids, Sized) or len(ids) > BATCH_SIZE)
+                # daemonic processes like the queue workers can not fork
+                and not multiprocessing.current_process().daemon)
+            ids = self.unprocessed_ids(ids)
+            if parallel:
+                chunks = self.render_chunks_parallel(ids, RENDER_PROCESSES,
+                    stats=stats)
+            else:
+                chunks = self.render_chunks(ids, stats=stats)
+            for template, messages, failures in chunks:
+                processed_ids = ([r.id for r, _ in messages]
+                    + [i for i, _ in failures])
+                chunk_merged = 0
+                with stats.stage('mime'):
+                    if self.deduplicate:
+                        messages, chunk_merged, digests = (
+                            self.deduplicate_messages(messages))
+                    for _, mail_message in messages:
+                        # the message is not serialized again to be measured
+                        stats.add_message(
+                            message_size(mail_message) + attachments_size)
+                        for part in attachments:
+                            mail_message.attach(part)
+                mails, create_failures = self.create_mails(template,
+                    messages, stored_attachments, stats=stats)
+                if self.deduplicate and create_failures:
+                    self.release_digests(digests,
+                        [i for i, _ in create_failures])
+                failures.extend(create_failures)
+                rendered += len(mails)
+                failed += len(failures)
+                merged += chunk_merged
+                if mails:
+                    with stats.stage('enqueue'):
+                        # call send_mail button. _send_mail is the queue
+                        ElectronicEmail.send_mail(mails)
+                with stats.stage('save'):
+                    if failures:
+                        Failure.create([{
+                                    'send': self.id,
+                                    'record_id': record_id,
+                                    'error': error,
+                                    } for record_id, error in failures])
+                    self.mark_processed(processed_ids)
+                    self.increment(rendered=len(mails), failed=len(failures),
+                        merged=chunk_merged)
+
+                    # bound the locks and the memory used by the send to a
+                    # chunk
+                    if commit:
+                        transaction.commit()
+                transaction.cache.clear()
+
+            values = stats.as_dict()
+            self.add_statistics(values)
+            if commit:
+                transaction.commit()
+
+        if not commit:
+            # only the chunk tasks of a send reuse its attachments
+            _attachments_cache.clear()
+
+        elapsed = time.monotonic() - start
+        logger.info('Generated %s emails from template %s in %.2fs '
+            '(%.1f rows/s, %s merged, %s failed)', rendered, self.template.id,
+            elapsed, rendered / elapsed if elapsed else 0, merged, failed)
+        logger.log(LOG_LEVEL, 'Statistics of the chunks of send %s:\n%s',
+            self.id, SendStats.format(values))
+
+    def add_statistics(self, values):
+        'Add the values to the statistics of the send'
+        Statistics = Pool().get('electronic.mail.wizard.send.statistics')
+        # the chunks of a send may be processed by concurrent queue tasks so
+        # each processing stores its own statistics instead of updating the
+        # send
+        Statistics.create([{
+                    'send': self.id,
+                    'statistics': values,
+                    }])
+
+    def deduplicate_messages(self, messages):
+        '''Collapse the messages with the same recipients and content
+        The attachments of a duplicate are merged into the kept message of
+        the chunk when merge attachments is set. The digests of the kept
+        messages are stored on the send to collapse the duplicates of the
+        other chunks, which may be processed by concurrent queue tasks, so
+        only the messages of the chunk are kept in memory.
+        :param messages: list of (record, message) of the chunk
+        :return: the messages to store, the number of merged messages and
+            the dict of record id: (digest, attachment digests, attachment
+            digests stored before or None) of the messages to store
+        '''
+        # digest: [record, message, attachment digests] of the last message
+        # kept with the digest
+        seen = {}
+        kept = []
+        merged = 0
+        for record, mail_message in messages:
+            digest, attachments = message_digests(mail_message)
+            if digest in seen:
+                _, kept_message, kept_attachments = seen[digest]
+                new_attachments = set(attachments) - kept_attachments
+                if not new_attachments:
+                    merged += 1
+                    continue
+                if self.merge_attachments:
+                    for attachment in sorted(new_attachments):
+                        kept_message.attach(attachments[attachment])
+                    kept_attachments.update(new_attachments)
+                    merged += 1
+                    continue
+            seen[digest] = [record, mail_message, set(attachments)]
+            kept.append((digest, seen[digest]))
+
+        sent = defaultdict(set)
+        for digest, (_, _, attachments) in kept:
+            sent[digest].update(attachments)
+        stored = self.store_digests(sent)
+        result, digests = [], {}
+        for digest, (record, mail_message, attachments) in kept:
+            if digest in stored and attachments <= stored[digest]:
+                merged += 1
+                continue
+            result.append((record, mail_message))
+            digests[record.id] = (digest, attachments, stored.get(digest))
+        return result, merged, digests
+
+    def store_digests(self, digests):
+        '''Store the digests of the messages to send
+        The digests stored before by another chunk keep the union of the
+        attachments sent with them.
+        :param digests: dict of digest: set of attachment digests
+        :return: dict of digest: set of attachment digests stored before
+        '''
+        pool = Pool()
+        Digest = pool.get('electronic.mail.wizard.send.digest')
+        transaction = Transaction()
+        database = transaction.database
+        table = Digest.__table__()
+        cursor = transaction.connection.cursor()
+
+        def read(digests):
+            cursor.execute(*table.select(table.digest, table.attachments,
+                    where=(table.send == self.id)
+                    & table.digest.in_(list(digests))))
+            return {d: set((a or '').split()) for d, a in cursor}
+
+        stored = {}
+        for sub_digests in grouped_slice(list(digests)):
+            sub_digests = list(sub_digests)
+            stored.update(read(sub_digests))
+            new = [d for d in sub_digests if d not in stored]
+            if not new:
+                continue
+            query = table.insert([table.send, table.digest,
+                    table.attachments, table.create_uid, table.create_date],
+                [[self.id, d, ' '.join(sorted(digests[d])), transaction.user,
+                        CurrentTimestamp()] for d in new])
+            if database.has_insert_on_conflict() and database.has_returning():
+                # a concurrent task may store the same digests meanwhile
+                query.on_conflict = Conflict(table,
+                    indexed_columns=[table.send, table.digest])
+                query.returning = [table.digest]
+                cursor.execute(*query)
+                inserted = {d for d, in cursor}
+                stored.update(read(d for d in new if d not in inserted))
+            else:
+                cursor.execute(*query)
+        for digest, attachments in stored.items():
+            if not digests[digest] <= attachments:
+                self._write_digest(digest, attachments | digests[digest])
+        return stored
+
+    def release_digests(self, digests, record_ids):
+        '''Remove from the stored digests the messages of the record ids
+        which could not be stored so their duplicates are sent
+        :param digests: the dict of the messages returned by
+            deduplicate_messages
+        '''
+        record_ids = set(record_ids)
+        released = {digests[i][0] for i in record_ids if i in digests}
+        if not released:
+            return
+        # digest: [attachment digests, created]
+        values = {}
+        for record_id, (digest, attachments, before) in digests.items():
+            if digest not in released:
+                continue
+            value = values.setdefault(digest,
+                [set(before or ()), before is not None])
+            if record_id not in record_ids:
+                value[0].update(attachments)
+                value[1] = True
+        for digest, (attachments, created) in values.items():
+            self._write_digest(digest, attachments if created else None)
+
+    def _write_digest(self, digest, attachments):
+        'Write the attachments of the stored digest or delete it if None'
+        Digest = Pool().get('electronic.mail.wizard.send.digest')
+        table = Digest.__table__()
+        cursor = Transaction().connection.cursor()
+        where = (table.send == self.id) & (table.digest == digest)
+        if attachments is None:
+            cursor.execute(*table.delete(where=where))
+        else:
+            cursor.execute(*table.update([table.attachments],
+                    [' '.join(sorted(attachments))], where=where))
+
+    def render_chunks(self, ids, stats=None):
+        '''Render the template for the ids by chunks
+        Each chunk is yielded under the context of its language.
+        :return: iterator of (template, list of (record, message),
+            list of (record id, error))
+        '''
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        Model = pool.get(self.template.model.name)
+        if stats is None:
+            stats = SendStats()
+
+        # the ids may be streamed so they are grouped by language by pages
+        for page in iter_chunks(ids, PAGE_SIZE):
+            languages = self.group_by_language(page, stats=stats)
+            for language, lang_ids in languages.items():
+                # load data in language when send a record
+                with Transaction().set_context(language=language):
+                    with stats.stage('load'):
+                        template = Template(self.template.id)
+                        values = self.get_values(template)
+                    for sub_ids in grouped_slice(lang_ids, BATCH_SIZE):
+                        with stats.stage('load'):
+                            # browse the whole slice at once so the lazy
+                            # field accesses done by the template expressions
+                            # are read for all the records of the slice with
+                            # a single query
+                            records = Model.browse(list(sub_ids))
+                        messages, failures = self.render_mails(template,
+                            records, values, stats=stats)
+                        yield template, messages, failures
+
+    def render_chunks_parallel(self, ids, processes, stats=None):
+        '''Render the template for the ids by chunks in processes
+        Each process renders with its own pool and transaction and the
+        messages are returned to be stored in the current transaction.
+        '''
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        Model = pool.get(self.template.model.name)
+        if stats is None:
+            stats = SendStats()
+
+        transaction = Transaction()
+        # the send may not be committed so the workers get its values
+        values = {n: getattr(self, n) for n in SEND_FIELDS}
+        values['template'] = self.template.id
+        sections = {s: dict(config.items(s)) for s in config.sections()}
+        worker_context = {k: v for k, v in transaction.context.items()
+            if k not in ACTIVE_KEYS}
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(processes, mp_context=context,
+                initializer=init_worker, initargs=(sections,)) as executor:
+            # the chunks are submitted as the results are consumed so the
+            # ids may be streamed and the rendered messages do not pile up
+            chunks = iter_chunks(ids, BATCH_SIZE)
+            futures = deque()
+            while True:
+                for sub_ids in islice(chunks, processes * 2 - len(futures)):
+                    futures.append(executor.submit(render_worker,
+                            transaction.database.name, transaction.user,
+                            worker_context, values, sub_ids))
+                if not futures:
+                    break
+                # the workers render in their own transaction
+                with stats.stage('render'):
+                    result = futures.popleft().result()
+                for language, messages, failures in result:
+                    with Transaction().set_context(language=language), \
+                            stats.stage('load'):
+                        template = Template(self.template.id)
+                        records = Model.browse([i for i, _ in messages])
+                    yield template, [
+                        (r, message_from_bytes(m))
+                        for r, (_, m) in zip(records, messages)
+                        ], failures
+
+    def get_language(self, template, record):
+        'Return the language used to render the template for the record'
+        if template.language:
+            try:
+                with savepoint():
+                    return template.eval(template.language, record)
+            except Exception:
+                # the record fails when it is rendered
+                logger.warning('Could not evaluate the language of %s',
+                    record, exc_info=True)
+        return self.get_default_language()
+
+    def get_default_language(self):
+        '''Return the language of the records when the template has none
+        The queue tasks are run without the language of the user.
+        '''
+        return self.language or Transaction().context.get('language')
+
+    def group_by_language(self, ids, stats=None):
+        '''Group the ids of the records by the language of the template
+        :param ids: list of ids
+        :return: dict of language: list of ids
+        '''
+        pool = Pool()
+        template = self.template
+        if not template.language:
+            return {self.get_default_language(): list(ids)}
+        Model = pool.get(template.model.name)
+        if stats is None:
+            stats = SendStats()
+        languages = defaultdict(list)
+        for sub_ids in grouped_slice(ids, BATCH_SIZE):
+            with stats.stage('language'):
+                for record in Model.browse(list(sub_ids)):
+                    languages[self.get_language(template, record)].append(
+                        record.id)
+                Transaction().cache.clear()
+        return languages
+
+    def get_values(self, template):
+        'Return the values to render the template'
+        values = {
+            'from_': self.from_,
+            'sender': self.sender,
+            'to': self.to,
+            'cc': self.cc,
+            'bcc': self.bcc,
+            'message_id': self.message_id,
+            'in_reply_to': self.in_reply_to,
+            'references': self.references,
+            'template': template.id,
+            }
+        if self.use_tmpl_fields:
+            tmpl_fields = ('subject', 'markdown')
+            for field_name in tmpl_fields:
+                values[field_name] = getattr(template, field_name)
+        else:
+            values.update({
+                'subject': self.subject,
+                'markdown': self.markdown,
+                })
+        return values
+
+    def get_attachments(self):
+        '''Return the MIME parts of the attachments shared by all the mails
+        and the stored attachments they reference
+        '''
+        pool = Pool()
+        StoredAttachment = pool.get('electronic.mail.stored_attachment')
+        # the create date distinguishes the sends rolled back
+        key = (Transaction().database.name, self.id, self.create_date)
+        cached = _attachments_cache.pop(key, None)
+        if cached is not None and cached[0] > time.monotonic():
+            expire, attachments, digests = cached
+            # the stored attachments created by a transaction rolled back
+            # may not exist or their ids may be reused
+            stored_attachments = StoredAttachment.search([
+                    ('id', 'in', list(digests)),
+                    ])
+            if {a.id: a.digest for a in stored_attachments} == digests:
+                _attachments_cache[key] = cached
+                return attachments, stored_attachments
+        attachments, stored_attachments = [], []
+        for attachment in self.attachments:
+            if self.store_attachments:
+                stored_attachment = attachment.attachment
+                if not stored_attachment:
+                    data = attachment.get_data()
+                    if not data:
+                        continue
+                    stored_attachment = StoredAttachment.get_or_create(data)
+                stored_attachments.append(stored_attachment)
+                attachments.append(stored_attachment_part(
+                        attachment.name, stored_attachment.digest))
+            else:
+                data = attachment.get_data()
+                if not data:
+                    continue
+                attachments.append(attachment_part(attachment.name, data))
+        _attachments_cache[key] = (
+            time.monotonic() + ATTACHMENTS_CACHE_DURATION, attachments,
+            {a.id: a.digest for a in stored_attachments})
+        return attachments, stored_attachments
+
+    def render_mails(self, template, records, values, stats=None):
+        '''Render the template for the records
+        A record that fails to render does not stop the other ones.
+        :return: list of (record, email.message.Message) and
+            list of (record id, error)
+        '''
+        Template = Pool().get('electronic.mail.template')
+        if stats is None:
+            stats = SendStats()
+        messages, failures = [], []
+        for record in records:
+            try:
+                # a database error of an expression must not abort the
+                # transaction of the other records
+                with stats.stage('render'), savepoint():
+                    message = Template.render(template, record, values)
+                messages.append((record, message))
+            except Exception as exception:
+                logger.warning('Could not render %s', record, exc_info=True)
+                failures.append((record.id, str(exception)))
+        return messages, failures
+
+    def create_mails(self, template, messages, stored_attachments=None,
+            stats=None):
+        '''Create the electronic mails of the rendered messages
+        The template and the stored attachments are set to all the mails of
+        the chunk with a single write.
+        :return: list of electronic.mail and list of (record id, error)
+        '''
+        ElectronicEmail = Pool().get('electronic.mail')
+        if stats is None:
+            stats = SendStats()
+        mails, failures = [], []
+        for record, mail_message in messages:
+            try:
+                with stats.stage('create'), savepoint():
+                    electronic_mail = ElectronicEmail.create_from_mail(
+                        mail_message, template.mailbox.id, record)
+            except Exception as exception:
+                logger.warning('Could not create the email of %s', record,
+                    exc_info=True)
+                failures.append((record.id, str(exception)))
+                continue
+            if electronic_mail:
+                mails.append(electronic_mail)
+            else:
+                failures.append((record.id, gettext(
+                            'electronic_mail_wizard.msg_email_not_created')))
+        if mails:
+            values = {'template': template.id}
+            if stored_attachments:
+                values['stored_attachments'] = [
+                    ('add', [a.id for a in stored_attachments])]
+            with stats.stage('save'):
+                ElectronicEmail.write(mails, values)
+        return mails, failures
+
+    @classmethod
+    def delete(cls, sends):
+        pool = Pool()
+        StoredAttachment = pool.get('electronic.mail.stored_attachment')
+        attachment_ids = {a.attachment.id for s in sends
+            for a in s.attachments if a.attachment}
+        super(TemplateEmailSend, cls).delete(sends)
+        StoredAttachment.delete_unused(attachment_ids)
+
+
+class TemplateEmailSendAttachment(ModelSQL, ModelView):
+    'Template Email Send Attachment'
+    __name__ = 'electronic.mail.wizard.send.attachment'
+
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        required=True, ondelete='CASCADE')
+    name = fields.Char('Name', readonly=True)
+    attachment = fields.Many2One('electronic.mail.stored_attachment',
+        'Attachment', readonly=True, ondelete='RESTRICT')
+    origin_attachment = fields.Many2One('ir.attachment', 'Origin Attachment',
+        readonly=True, ondelete='SET NULL')
+    size = fields.Function(fields.Integer('Size'), 'get_size')
+
+    @classmethod
+    def get_size(cls, attachments, name):
+        sizes = {}
+        origin_ids = []
+        for attachment in attachments:
+            if attachment.attachment:
+                sizes[attachment.id] = attachment.attachment.size
+            elif attachment.origin_attachment:
+                origin_ids.append(attachment.origin_attachment.id)
+        origin_sizes = get_attachment_sizes(origin_ids)
+        for attachment in attachments:
+            if attachment.id not in sizes and attachment.origin_attachment:
+                sizes[attachment.id] = origin_sizes.get(
+                    attachment.origin_attachment.id)
+        return sizes
+
+    def get_data(self):
+        'Return the data of the attachment'
+        if self.attachment:
+            return self.attachment.data
+        elif self.origin_attachment:
+            # origin attachments are read from the filestore only when the
+            # send is processed
+            return self.origin_attachment.data
+
+
+class TemplateEmailSendFailure(ModelSQL, ModelView):
+    'Template Email Send Failure'
+    __name__ = 'electronic.mail.wizard.send.failure'
+
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        required=True, ondelete='CASCADE')
+    record_id = fields.Integer('Record ID', required=True, readonly=True)
+    record = fields.Function(fields.Char('Record'), 'get_record')
+    error = fields.Text('Error', readonly=True)
+
+    def get_record(self, name):
+        pool = Pool()
+        Model = pool.get(self.send.template.model.name)
+        record = Model(self.record_id)
+        try:
+            return record.rec_name
+        except Exception:
+            return '%s,%s' % (Model.__name__, self.record_id)
+
+
+class TemplateEmailSendRecord(ModelSQL):
+    'Template Email Send Record'
+    __name__ = 'electronic.mail.wizard.send.record'
+
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        required=True, ondelete='CASCADE')
+    record_id = fields.Integer('Record ID', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateEmailSendRecord, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('send_record_uniq', Unique(t, t.send, t.record_id),
+                'electronic_mail_wizard.msg_send_record_unique'),
+            ]
+
+
+class TemplateEmailSendStatistics(ModelSQL):
+    'Template Email Send Statistics'
+    __name__ = 'electronic.mail.wizard.send.statistics'
+
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        required=True, ondelete='CASCADE')
+    statistics = fields.Dict(None, 'Statistics', readonly=True)
+
+
+class TemplateEmailSendDigest(ModelSQL):
+    'Template Email Send Digest'
+    __name__ = 'electronic.mail.wizard.send.digest'
+
+    send = fields.Many2One('electronic.mail.wizard.send', 'Send',
+        required=True, ondelete='CASCADE')
+    digest = fields.Char('Digest', required=True,
+        help='SHA-256 of the recipients and content of the email.')
+    attachments = fields.Text('Attachments',
+        help='SHA-256 of the attachments sent with the email.')
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateEmailSendDigest, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('send_digest_uniq', Unique(t, t.send, t.digest),
+                'electronic_mail_wizard.msg_send_digest_unique'),
+            ]
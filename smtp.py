@@ -0,0 +1,171 @@
+# This file is part electronic_mail_wizard module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond import sendmail
+from trytond.config import config
+
+__all__ = ['pooled_smtp']
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of messages sent per second, 0 for no limit
+RATE = config.getfloat('email', 'wizard_smtp_rate', default=0)
+# Number of messages sent through a SMTP connection before it is renewed
+MAX_PER_CONNECTION = config.getint('email', 'wizard_smtp_max_per_connection',
+    default=100)
+
+_local = threading.local()
+_get_smtp_server = sendmail.get_smtp_server
+
+
+class RateLimiter(object):
+    'Space the messages sent by all the threads of the process'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not RATE:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + 1 / RATE
+        if at > now:
+            time.sleep(at - now)
+
+
+rate_limiter = RateLimiter()
+
+
+class PooledSMTP(object):
+    '''SMTP connection reused by the messages sent inside pooled_smtp
+    The quit of the senders is ignored as the pool closes the connection.
+    '''
+
+    def __init__(self, pool, key, server):
+        self._pool = pool
+        self._key = key
+        self._server = server
+        self.sent = 0
+
+    def _send(self, method, *args, **kwargs):
+        prepare = self._pool.prepare
+        if prepare is not None:
+            # the message is the first argument of send_message and the
+            # third of sendmail
+            index = 0 if method == 'send_message' else 2
+            if 'msg' in kwargs:
+                kwargs['msg'] = prepare(kwargs['msg'])
+            elif len(args) > index:
+                args = list(args)
+                args[index] = prepare(args[index])
+        rate_limiter.wait()
+        try:
+            result = getattr(self._server, method)(*args, **kwargs)
+        except smtplib.SMTPServerDisconnected:
+            self._pool.discard(self._key, self)
+            raise
+        self.sent += 1
+        if self.sent >= MAX_PER_CONNECTION:
+            self._pool.discard(self._key, self)
+        return result
+
+    def send_message(self, *args, **kwargs):
+        return self._send('send_message', *args, **kwargs)
+
+    def sendmail(self, *args, **kwargs):
+        return self._send('sendmail', *args, **kwargs)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _quit(self):
+        try:
+            self._server.quit()
+        except smtplib.SMTPException:
+            self._server.close()
+
+    def __getattr__(self, name):
+        return getattr(self._server, name)
+
+
+class SMTPPool(object):
+    '''SMTP connections by URI
+    prepare is called with each message before it is sent and returns the
+    message to send.
+    '''
+
+    def __init__(self, prepare=None):
+        self.connections = {}
+        self.opened = 0
+        self.prepare = prepare
+
+    def get(self, uri=None, strict=False):
+        key = uri or config.get('email', 'uri')
+        connection = self.connections.get(key)
+        if connection is None:
+            server = _get_smtp_server(uri, strict=strict)
+            if not server:
+                return
+            self.opened += 1
+            connection = self.connections[key] = PooledSMTP(
+                self, key, server)
+        return connection
+
+    def discard(self, key, connection):
+        if self.connections.get(key) is connection:
+            del self.connections[key]
+        connection._quit()
+
+    def close(self):
+        for key, connection in list(self.connections.items()):
+            self.discard(key, connection)
+
+
+def get_smtp_server(uri=None, strict=False):
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        return _get_smtp_server(uri, strict=strict)
+    return pool.get(uri, strict=strict)
+
+
+# the senders of trytond.sendmail get their server from the pool
+sendmail.get_smtp_server = get_smtp_server
+
+
+@contextmanager
+def pooled_smtp(prepare=None):
+    '''Reuse the SMTP connections of the messages sent inside the block
+    The messages are limited to the rate and each connection is renewed
+    after the maximum number of messages.
+    :param prepare: function called with each message sent inside the block
+        that returns the message to send
+    '''
+    pool = getattr(_local, 'pool', None)
+    if pool is not None:
+        previous = pool.prepare
+        if prepare is not None:
+            pool.prepare = prepare
+        try:
+            yield pool
+        finally:
+            pool.prepare = previous
+        return
+    pool = _local.pool = SMTPPool(prepare)
+    try:
+        yield pool
+    finally:
+        _local.pool = None
+        pool.close()
+        logger.debug('Closed the pool of %s SMTP connections', pool.opened)
@@ -0,0 +1,153 @@
+# This file is part electronic_mail_wizard module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import cProfile
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['SendStats', 'count_queries', 'profile']
+
+# Level of the log of the statistics of each processed chunk list
+LOG_LEVEL = logging.getLevelName(
+    config.get('email', 'wizard_log_level', default='INFO').upper())
+if not isinstance(LOG_LEVEL, int):
+    # getLevelName returns a string for an unknown level name
+    LOG_LEVEL = logging.INFO
+# Directory where the cProfile dump of each processing is written
+PROFILE_DIR = config.get('email', 'wizard_profile', default='')
+# Stages of the processing in order
+STAGES = ['load', 'language', 'render', 'mime', 'create', 'save', 'enqueue']
+
+
+class QueryCounter(object):
+    'Count the SQL queries executed through the connection'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self, self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def count_queries():
+    'Count the queries of the current transaction inside the block'
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = QueryCounter(connection)
+    transaction.connection = counter
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def profile(name):
+    'Dump the cProfile of the block in the profile directory if set'
+    if not PROFILE_DIR:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(PROFILE_DIR,
+                '%s-%s.prof' % (name, time.strftime('%Y%m%d%H%M%S'))))
+
+
+class SendStats(object):
+    '''Timings and counters of the stages of a send
+    The queries are counted only inside count_queries.
+    '''
+
+    def __init__(self, counter=None):
+        self.counter = counter
+        self.stages = {}
+        self.messages = 0
+        self.bytes = 0
+
+    @contextmanager
+    def stage(self, name):
+        'Add the time and the queries of the block to the stage'
+        queries = self.counter.queries if self.counter else 0
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {
+                    'calls': 0,
+                    'seconds': 0.0,
+                    'queries': 0,
+                    })
+            stage['calls'] += 1
+            stage['seconds'] += time.monotonic() - start
+            if self.counter:
+                stage['queries'] += self.counter.queries - queries
+
+    def add_message(self, size):
+        self.messages += 1
+        self.bytes += size
+
+    def as_dict(self):
+        result = {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            }
+        for name, stage in self.stages.items():
+            for key, value in stage.items():
+                result['%s_%s' % (name, key)] = value
+        return result
+
+    @staticmethod
+    def merge(*stats):
+        'Return the sum of the dicts of statistics'
+        result = {}
+        for values in stats:
+            for key, value in (values or {}).items():
+                result[key] = result.get(key, 0) + value
+        return result
+
+    @staticmethod
+    def format(values):
+        'Return the human readable summary of the dict of statistics'
+        values = values or {}
+        messages = values.get('messages', 0)
+        lines = ['%s messages, %s bytes (%s bytes/message)' % (
+                messages, values.get('bytes', 0),
+                values.get('bytes', 0) // messages if messages else 0)]
+        for name in STAGES:
+            if ('%s_calls' % name) not in values:
+                continue
+            lines.append('%s: %.3fs, %s calls, %s queries' % (name,
+                    values['%s_seconds' % name], values['%s_calls' % name],
+                    values.get('%s_queries' % name, 0)))
+        return '\n'.join(lines)
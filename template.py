@@ -1,13 +1,80 @@
 # This file is part electronic_mail_wizard module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from itertools import chain
+from threading import Lock
+
+from genshi.template import TextTemplate
+from genshi.template.base import TEXT
+from jinja2 import Environment, nodes
+
+from trytond.cache import LRUDict
+from trytond.config import config
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
-from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, without_check_access
 
 __all__ = ['Template']
 
+EXPRESSION_CACHE_SIZE = config.getint('email', 'expression_cache_size',
+    default=1024)
+
+
+class ExpressionCache(object):
+    '''LRU cache of the text of the template expressions of the process
+    None is cached for the expressions with placeholders.
+    '''
+
+    def __init__(self, size):
+        self._cache = LRUDict(size)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile_):
+        with self._lock:
+            try:
+                compiled = self._cache[key]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                return compiled
+        compiled = compile_()
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = compiled
+        return compiled
+
+    def invalidate(self, template_ids):
+        template_ids = set(template_ids)
+        with self._lock:
+            for key in list(self._cache.keys()):
+                if key[0] in template_ids:
+                    del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache),
+            }
+
+
+expression_cache = ExpressionCache(EXPRESSION_CACHE_SIZE)
+
+
+# MIME part of the body rendered from the static markdown of the templates or
+# False when the body of the template can not be reused
+body_cache = ExpressionCache(EXPRESSION_CACHE_SIZE)
+
 
 class Template(metaclass=PoolMeta):
     __name__ = 'electronic.mail.template'
@@ -42,79 +109,250 @@ class Template(metaclass=PoolMeta):
 
     @classmethod
     def create(cls, vlist):
+        pool = Pool()
+        Start = pool.get('electronic.mail.wizard.templateemail.start')
         templates = super(Template, cls).create(vlist)
         cls.create_wizards(templates)
+        Start._get_origin_cache.clear()
         return templates
 
     @classmethod
     def write(cls, *args):
         pool = Pool()
         Wizard = pool.get('ir.action.wizard')
+        Start = pool.get('electronic.mail.wizard.templateemail.start')
+        all_templates = list(chain(*args[::2]))
+
+        actions = iter(args)
+        renamed_ids = [t.id for templates, values in zip(actions, actions)
+            if values.get('name') for t in templates]
+        old_names = {}
+        if renamed_ids:
+            old_names = {t['id']: t['name']
+                for t in cls.read(renamed_ids, ['name'])}
+
         super(Template, cls).write(*args)
+        expression_cache.invalidate([t.id for t in all_templates])
+        body_cache.invalidate([t.id for t in all_templates])
+
+        wizards = cls._get_wizards([t.id for t in all_templates])
+        to_create, to_delete, renamed = [], [], {}
         actions = iter(args)
         for templates, values in zip(actions, actions):
+            if 'model' in values:
+                Start._get_origin_cache.clear()
             if 'create_action' in values:
                 if values['create_action']:
-                    cls.create_wizards(templates)
+                    to_create.extend(t for t in templates
+                        if t.id not in wizards)
                 else:
-                    cls.delete_wizards(templates)
+                    to_delete.extend(t for t in templates
+                        if t.id in wizards)
             if values.get('name'):
-                wizards = [t.wizard for t in templates if t.wizard]
-                if wizards:
-                    with Transaction().set_context(_check_access=False):
-                        Wizard.write(wizards, {
-                                'name': values.get('name'),
-                                })
+                renamed.update((t.id, t) for t in templates
+                    if t.id in wizards
+                    and old_names.get(t.id) != values['name'])
+        if to_create:
+            cls.create_wizards(to_create)
+        if to_delete:
+            cls.delete_wizards(to_delete)
+        deleted = {t.id for t in to_delete}
+        renamed = [t for i, t in renamed.items() if i not in deleted]
+        if renamed:
+            with Transaction().set_context(_check_access=False):
+                cls._set_wizard_names(renamed,
+                    Wizard.browse([wizards[t.id][0] for t in renamed]))
 
     @classmethod
     def delete(cls, templates):
+        pool = Pool()
+        Start = pool.get('electronic.mail.wizard.templateemail.start')
+        Send = pool.get('electronic.mail.wizard.send')
         cls.delete_wizards(templates, ensure_create_action=False)
+        # the sends are deleted before the cascade to remove their stored
+        # attachments from the filestore
+        with without_check_access():
+            sends = Send.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ])
+            if sends:
+                Send.delete(sends)
+        expression_cache.invalidate([t.id for t in templates])
+        body_cache.invalidate([t.id for t in templates])
         super(Template, cls).delete(templates)
+        Start._get_origin_cache.clear()
 
     @classmethod
-    def create_wizards(cls, templates):
+    def render(cls, template, record, values):
+        '''Render the email reusing the body of a static markdown
+        The markdown without placeholders is converted to HTML once for the
+        template version and its body is added to the emails rendered
+        without markdown.
+        '''
+        markdown = values.get('markdown')
+        if template.static_text(markdown, record) is None:
+            return super(Template, cls).render(template, record, values)
+        key = (template.id, template.write_date or template.create_date,
+            Transaction().context.get('language'), markdown)
+        body = body_cache.get(key,
+            lambda: cls._static_body(template, record, values))
+        if body is False:
+            return super(Template, cls).render(template, record, values)
+        message = super(Template, cls).render(template, record,
+            dict(values, markdown=None))
+        # the part is shared by the emails like the attachment parts
+        message.get_payload().insert(0, body)
+        return message
+
+    @classmethod
+    def _static_body(cls, template, record, values):
+        '''Return the first MIME part of the email rendered with the markdown
+        or False if the email rendered without markdown differs by more
+        than this part
+        '''
+        message = super(Template, cls).render(template, record, values)
+        empty = super(Template, cls).render(template, record,
+            dict(values, markdown=None))
+        if (not message.is_multipart() or not empty.is_multipart()
+                or message.get_content_type() != empty.get_content_type()):
+            return False
+        parts, empty_parts = message.get_payload(), empty.get_payload()
+        if (len(parts) != len(empty_parts) + 1
+                or [p.as_bytes() for p in parts[1:]]
+                != [p.as_bytes() for p in empty_parts]):
+            return False
+        return parts[0]
+
+    def eval(self, expression, record):
+        '''Evaluates the expression reusing its text when it has no
+        placeholders for the same template version
+        '''
+        text = self.static_text(expression, record)
+        if text is None:
+            return super(Template, self).eval(expression, record)
+        return text
+
+    def static_text(self, expression, record):
+        '''Return the text of the expression if it has no placeholders or
+        None
+        The text is rendered by the engine once for the template version and
+        reused verbatim for all the records.
+        '''
+        if (not expression or self.id is None or self.id < 0
+                or self.engine not in {'genshi', 'jinja2'}):
+            return None
+
+        def render():
+            if not self.is_static(expression):
+                return None
+            return super(Template, self).eval(expression, record)
+        key = (self.id, self.write_date or self.create_date, self.engine,
+            expression)
+        return expression_cache.get(key, render)
+
+    def is_static(self, expression):
+        '''Return if the expression has no placeholders
+        The expression is only parsed, the engine of electronic_mail_template
+        renders it.
+        '''
+        try:
+            if self.engine == 'genshi':
+                return all(kind == TEXT
+                    for kind, _, _ in TextTemplate(expression).stream)
+            elif self.engine == 'jinja2':
+                return all(isinstance(node, nodes.Output)
+                    and all(isinstance(n, nodes.TemplateData)
+                        for n in node.nodes)
+                    for node in Environment().parse(expression).body)
+        except Exception:
+            # the engine reports the syntax errors when rendering
+            pass
+        return False
+
+    @classmethod
+    def _get_wizards(cls, template_ids):
+        '''Return the wizard and action ids of the templates
+        :return: dict of template id: (wizard id, action id)
+        '''
+        pool = Pool()
+        Wizard = pool.get('ir.action.wizard')
+        template = cls.__table__()
+        wizard = Wizard.__table__()
+        cursor = Transaction().connection.cursor()
+        result = {}
+        for sub_ids in grouped_slice(template_ids):
+            cursor.execute(*template.join(wizard,
+                    condition=template.wizard == wizard.id
+                    ).select(template.id, wizard.id, wizard.action,
+                    where=reduce_ids(template.id, sub_ids)))
+            result.update((t, (w, a)) for t, w, a in cursor)
+        return result
+
+    @classmethod
+    def _set_wizard_names(cls, templates, wizards):
+        '''Write the names of the templates in all the translatable languages
+        to their wizards
+        '''
         pool = Pool()
-        Keyword = pool.get('ir.action.keyword')
         Wizard = pool.get('ir.action.wizard')
         Lang = pool.get('ir.lang')
         langs = Lang.search([
             ('translatable', '=', True),
             ])
+        template_ids = [t.id for t in templates]
+        wizard_ids = [w.id for w in wizards]
+        for lang in langs:
+            with Transaction().set_context(language=lang.code,
+                    fuzzy_translation=False):
+                names = {t['id']: t['name']
+                    for t in cls.read(template_ids, ['name'])}
+                wizard_names = {w['id']: w['name']
+                    for w in Wizard.read(wizard_ids, ['name'])}
+                to_write = []
+                for template, wizard in zip(templates, wizards):
+                    name = names[template.id]
+                    if name != wizard_names[wizard.id]:
+                        to_write.extend(([wizard], {'name': name}))
+                if to_write:
+                    Wizard.write(*to_write)
+
+    @classmethod
+    def create_wizards(cls, templates):
+        pool = Pool()
+        Keyword = pool.get('ir.action.keyword')
+        Wizard = pool.get('ir.action.wizard')
+        templates = [t for t in templates if t.create_action]
+        if not templates:
+            return
         with Transaction().set_context(_check_access=False):
-            for template in templates:
-                if not template.create_action:
-                    continue
-                wizard = Wizard()
-                wizard.name = template.name
-                wizard.wiz_name = 'electronic_mail_wizard.templateemail'
-                wizard.save()
-                template.wizard = wizard
-                template.save()
-
-                if langs:
-                    for lang in langs:
-                        with Transaction().set_context(language=lang.code,
-                                fuzzy_translation=False):
-                            lang_name, = cls.read([template.id], ['name'])
-                            Wizard.write([wizard], lang_name)
-
-                keyword = Keyword()
-                keyword.keyword = 'form_action'
-                keyword.action = wizard.action
-                keyword.model = '%s,-1' % template.model.name
-                keyword.save()
+            wizards = Wizard.create([{
+                        'name': t.name,
+                        'wiz_name': 'electronic_mail_wizard.templateemail',
+                        } for t in templates])
+            to_write = []
+            for template, wizard in zip(templates, wizards):
+                to_write.extend(([template], {'wizard': wizard.id}))
+            cls.write(*to_write)
+            cls._set_wizard_names(templates, wizards)
+
+            Keyword.create([{
+                        'keyword': 'form_action',
+                        'action': w.action.id,
+                        'model': '%s,-1' % t.model.name,
+                        } for t, w in zip(templates, wizards)])
 
     @classmethod
     def delete_wizards(cls, templates, ensure_create_action=True):
         pool = Pool()
         Keyword = pool.get('ir.action.keyword')
         Wizard = pool.get('ir.action.wizard')
-        wizards = [t.wizard for t in templates if t.wizard
-            and (not ensure_create_action or not t.create_action)]
+        if ensure_create_action:
+            templates = [t for t in templates if not t.create_action]
+        wizards = cls._get_wizards([t.id for t in templates])
         if wizards:
             keywords = Keyword.search([
-                    ('action', 'in', [w.action for w in wizards]),
+                    ('action', 'in', [a for _, a in wizards.values()]),
                     ])
             if keywords:
                 Keyword.delete(keywords)
-            Wizard.delete(wizards)
+            Wizard.delete(Wizard.browse([w for w, _ in wizards.values()]))
@@ -0,0 +1,299 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+r'''Benchmarks of the bulk rendering and sending of the wizard
+
+They run only when the BENCHMARK environment variable is set:
+
+    BENCHMARK=1 python -m unittest \
+        trytond.modules.electronic_mail_wizard.tests.test_benchmark
+
+BENCHMARK_SIZES sets the numbers of records (default 100,1000,10000),
+BENCHMARK_TEMPLATES the numbers of templates of the create_wizards
+benchmark (default 10,100,500), BENCHMARK_QUERIES_PER_RECORD the maximum
+queries done by record to render and send (default the queries of the
+records browsed one by one) and BENCHMARK_OUTPUT the file where the results are written as JSON lines
+(default the standard output).
+The parallel rendering is only measured on a persistent database (DB_NAME).
+'''
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+from unittest.mock import patch
+
+from trytond.config import config
+from trytond.modules.electronic_mail_wizard import send as send_module
+from trytond.modules.electronic_mail_wizard.stats import count_queries
+from trytond.modules.electronic_mail_wizard.template import expression_cache
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DB_NAME, activate_module, drop_db, with_transaction)
+from trytond.transaction import Transaction
+
+from .test_module import SMTPSink, create_template, create_users, run_wizard
+
+BENCHMARK = os.environ.get('BENCHMARK')
+SIZES = [int(s) for s in
+    os.environ.get('BENCHMARK_SIZES', '100,1000,10000').split(',')]
+TEMPLATES = [int(s) for s in
+    os.environ.get('BENCHMARK_TEMPLATES', '10,100,500').split(',')]
+OUTPUT = os.environ.get('BENCHMARK_OUTPUT')
+QUERIES_PER_RECORD = os.environ.get('BENCHMARK_QUERIES_PER_RECORD')
+if QUERIES_PER_RECORD is not None:
+    QUERIES_PER_RECORD = float(QUERIES_PER_RECORD)
+
+LONG_MARKDOWN = '\n\n'.join(
+    '## Section %s\n\nDear ${record.name}, this is the paragraph %s of a '
+    'long statement for ${record.login} sent to ${record.email}.' % (i, i)
+    for i in range(50))
+# the complexity variants of the template
+TEMPLATES_VALUES = {
+    'simple': {},
+    'languages': {
+        'language': '${record.language.code if record.language else "en"}',
+        },
+    'attachments': {},
+    'long': {
+        'markdown': LONG_MARKDOWN,
+        },
+    }
+
+
+@unittest.skipUnless(BENCHMARK, 'benchmark')
+class ElectronicMailWizardBenchmark(unittest.TestCase):
+    'Benchmark ElectronicMailWizard module'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        drop_db()
+        activate_module('electronic_mail_wizard')
+        cls.results = []
+        cls.sink = SMTPSink()
+        thread = threading.Thread(target=cls.sink.serve_forever, daemon=True)
+        thread.start()
+        cls.uri = config.get('email', 'uri', default=None)
+        config.set('email', 'uri',
+            'smtp://127.0.0.1:%s' % cls.sink.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.sink.shutdown()
+        cls.sink.server_close()
+        if cls.uri is not None:
+            config.set('email', 'uri', cls.uri)
+        else:
+            config.remove_option('email', 'uri')
+        output = open(OUTPUT, 'a') if OUTPUT else sys.stdout
+        try:
+            for result in cls.results:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+        finally:
+            if OUTPUT:
+                output.close()
+        drop_db()
+
+    def setUp(self):
+        super().setUp()
+        # the chunks must not be committed to keep the runs isolated
+        patcher = patch.object(send_module, 'COMMIT_CHUNKS', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_users(self, count):
+        'Create the records with the languages of the benchmark'
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        User = pool.get('res.user')
+
+        langs = Lang.search([('code', 'in', ['en', 'es', 'fr'])])
+        Lang.write(langs, {'translatable': True})
+        users = create_users(count)
+        for lang in langs:
+            User.write(users[langs.index(lang)::len(langs)], {
+                    'language': lang.id,
+                    })
+        return users
+
+    def get_attachments(self):
+        Attachment = Pool().get(
+            'electronic.mail.wizard.templateemail.attachment')
+        return [Attachment(name='statement.pdf', data=os.urandom(100000))]
+
+    def measure(self, kind, records, **values):
+        'Render and send the records with the template kind'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        if kind == 'attachments':
+            values.setdefault('attachments', self.get_attachments())
+        template = create_template(**TEMPLATES_VALUES[kind])
+        expression_cache.clear()
+        start = time.monotonic()
+        with count_queries() as counter:
+            run_wizard(template, records, **values)
+        elapsed = time.monotonic() - start
+        send, = Send.search([
+                ('template', '=', template.id),
+                ], order=[('id', 'DESC')], limit=1)
+        mails = ElectronicEmail.search([('template', '=', template.id)])
+
+        # the emails are sent as the queue would do
+        self.sink.reset()
+        start = time.monotonic()
+        ElectronicEmail._send_mail(mails)
+        smtp_elapsed = time.monotonic() - start
+
+        return {
+            'seconds': elapsed,
+            'records_per_second': len(records) / elapsed if elapsed else 0,
+            'queries': counter.queries,
+            'queries_per_record': counter.queries / len(records),
+            'emails': len(mails),
+            'smtp_seconds': smtp_elapsed,
+            'smtp': dict(self.sink.counters),
+            'statistics': send.statistics,
+            }
+
+    def peak_memory(self, kind, records, **values):
+        'Return the peak memory of the render and send of the records'
+        if kind == 'attachments':
+            values.setdefault('attachments', self.get_attachments())
+        template = create_template(**TEMPLATES_VALUES[kind])
+        tracemalloc.start()
+        try:
+            run_wizard(template, records, **values)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    @with_transaction()
+    def test_render_and_send(self):
+        'Benchmark the render and send of the template variants'
+        users = self.create_users(max(SIZES))
+        for kind in TEMPLATES_VALUES:
+            for size in SIZES:
+                result = self.measure(kind, users[:size])
+                result['peak_memory'] = self.peak_memory(kind, users[:size])
+                result.update({
+                        'benchmark': 'render_and_send',
+                        'template': kind,
+                        'records': size,
+                        })
+                self.results.append(result)
+                self.assertEqual(result['emails'], size)
+
+    @with_transaction()
+    def test_render_and_send_queries(self):
+        '''Test the queries done per record by the render and send
+        The records browsed by slice are compared to the records browsed one
+        by one as they were before the batching.
+        '''
+        users = self.create_users(1000)
+
+        results = {}
+        for batch_size in [1, send_module.BATCH_SIZE]:
+            # the queries of the render processes are not counted
+            with patch.object(send_module, 'BATCH_SIZE', batch_size), \
+                    patch.object(send_module, 'RENDER_PROCESSES', 0):
+                result = self.measure('simple', users)
+            result.update({
+                    'benchmark': 'render_and_send_queries',
+                    'template': 'simple',
+                    'records': len(users),
+                    'batch_size': batch_size,
+                    })
+            self.results.append(result)
+            self.assertEqual(result['emails'], len(users))
+            results[batch_size] = result
+        before = results[1]['queries_per_record']
+        after = results[send_module.BATCH_SIZE]['queries_per_record']
+        self.assertLess(after, before)
+        if QUERIES_PER_RECORD is not None:
+            self.assertLessEqual(after, QUERIES_PER_RECORD)
+
+    @with_transaction()
+    def test_render_and_send_memory(self):
+        'Test the peak memory of a send does not grow with the records'
+        users = self.create_users(50000)
+
+        peaks = []
+        for count in [1000, 50000]:
+            peaks.append(self.peak_memory('simple', users[:count]))
+        self.results.append({
+                'benchmark': 'render_and_send_memory',
+                'records': [1000, 50000],
+                'peak_memory': peaks,
+                })
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+    @unittest.skipIf(DB_NAME == ':memory:',
+        'the render processes need a persistent database')
+    @with_transaction()
+    def test_render_parallel(self):
+        'Benchmark the parallel render against the serial one'
+        users = self.create_users(max(SIZES))
+        template = create_template()
+        # the render processes read the records in their own transaction
+        Transaction().commit()
+
+        processes = send_module.RENDER_PROCESSES or os.cpu_count()
+        for count in [0, processes]:
+            with patch.object(send_module, 'RENDER_PROCESSES', count):
+                start = time.monotonic()
+                run_wizard(template, users)
+                elapsed = time.monotonic() - start
+            self.results.append({
+                    'benchmark': 'render_parallel',
+                    'processes': count,
+                    'records': len(users),
+                    'seconds': elapsed,
+                    'records_per_second': len(users) / elapsed,
+                    })
+
+    @with_transaction()
+    def test_create_wizards(self):
+        'Benchmark the creation, rename and deletion of template wizards'
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        Model = pool.get('ir.model')
+        Template = pool.get('electronic.mail.template')
+
+        mailbox = Mailbox(name='Outbox')
+        mailbox.save()
+        model, = Model.search([('name', '=', 'res.user')])
+        for size in TEMPLATES:
+            result = {
+                'benchmark': 'create_wizards',
+                'templates': size,
+                }
+            with count_queries() as counter:
+                start = time.monotonic()
+                templates = Template.create([{
+                            'name': 'Template %s' % i,
+                            'model': model.id,
+                            'mailbox': mailbox.id,
+                            'from_': 'noreply@example.com',
+                            'to': '${record.email}',
+                            'subject': 'Subject %s' % i,
+                            } for i in range(size)])
+                result['create_seconds'] = time.monotonic() - start
+                result['create_queries'] = counter.queries
+
+                queries = counter.queries
+                start = time.monotonic()
+                Template.write(templates, {'name': 'Renamed'})
+                result['write_seconds'] = time.monotonic() - start
+                result['write_queries'] = counter.queries - queries
+
+                queries = counter.queries
+                start = time.monotonic()
+                Template.delete(templates)
+                result['delete_seconds'] = time.monotonic() - start
+                result['delete_queries'] = counter.queries - queries
+            self.results.append(result)
@@ -1,14 +1,662 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import json
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.mime.multipart import MIMEMultipart
+from unittest.mock import Mock, patch
 
+from trytond import sendmail
+from trytond.config import config
+from trytond.exceptions import UserError
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.modules.electronic_mail_wizard import (
+    electronic_mail_wizard, send as send_module, smtp)
+from trytond.modules.electronic_mail_wizard.attachment import (
+    get_attachment_sizes, stored_attachment_part)
+from trytond.modules.electronic_mail_wizard.smtp import pooled_smtp
+from trytond.modules.electronic_mail_wizard.template import (
+    body_cache, expression_cache)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    'Accept and discard the messages of a SMTP session'
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.count('connections')
+        self.reply('220 localhost SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    size += len(line)
+                self.server.count('messages')
+                self.server.count('bytes', size)
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    'Local SMTP server that only counts what it receives'
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {
+                'connections': 0,
+                'messages': 0,
+                'bytes': 0,
+                }
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+
+def create_template(**values):
+    'Create a template that sends an email to each res.user'
+    pool = Pool()
+    Mailbox = pool.get('electronic.mail.mailbox')
+    Model = pool.get('ir.model')
+    Template = pool.get('electronic.mail.template')
+
+    mailbox = Mailbox(name='Outbox')
+    mailbox.save()
+    model, = Model.search([('name', '=', 'res.user')])
+    template = Template()
+    template.name = 'Test'
+    template.model = model
+    template.mailbox = mailbox
+    template.from_ = 'noreply@example.com'
+    template.to = '${record.email}'
+    template.subject = 'Hello ${record.name}'
+    template.markdown = 'Dear ${record.name}, your login is ${record.login}'
+    for name, value in values.items():
+        setattr(template, name, value)
+    template.save()
+    return template
+
+
+def create_users(count):
+    User = Pool().get('res.user')
+    return User.create([{
+                'name': 'User %s' % i,
+                'login': 'user%s' % i,
+                'email': 'user%s@example.com' % i,
+                } for i in range(count)])
+
+
+def run_wizard(template, records, domain=None, **values):
+    '''Run the send transition of the wizard for template and records or
+    the records of the domain
+    '''
+    GenerateTemplateEmail = Pool().get('electronic_mail_wizard.templateemail',
+        type='wizard')
+    session_id, _, _ = GenerateTemplateEmail.create()
+    wizard = GenerateTemplateEmail(session_id)
+    context = {}
+    if domain is not None:
+        context['active_domain'] = domain
+    with Transaction().set_context(
+            active_model=template.model.name,
+            active_ids=[r.id for r in records or []],
+            action_id=template.wizard.id, **context):
+        for name, value in wizard.render_fields(wizard.__name__).items():
+            setattr(wizard.start, name, value)
+        wizard.start.use_tmpl_fields = True
+        wizard.start.attachments = []
+        wizard.start.origin_attachments = []
+        wizard.start.store_attachments = False
+        wizard.start.deduplicate = False
+        wizard.start.merge_attachments = False
+        wizard.start.background = False
+        for name, value in values.items():
+            setattr(wizard.start, name, value)
+        wizard.transition_send()
+    return wizard
 
 
 class ElectronicMailWizardTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ElectronicMailWizard module'
     module = 'electronic_mail_wizard'
 
+    def setUp(self):
+        super().setUp()
+        # the chunks must not be committed to keep the tests isolated
+        patcher = patch.object(send_module, 'COMMIT_CHUNKS', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @with_transaction()
+    def test_statistics(self):
+        'Test the statistics of the stages are stored on the send'
+        Send = Pool().get('electronic.mail.wizard.send')
+
+        template = create_template()
+        users = create_users(10)
+
+        run_wizard(template, users)
+        send, = Send.search([('template', '=', template.id)])
+        statistics = send.statistics
+        self.assertEqual(statistics['messages'], len(users))
+        self.assertGreater(statistics['bytes'], 0)
+        self.assertEqual(statistics['render_calls'], len(users))
+        self.assertEqual(statistics['create_calls'], len(users))
+        self.assertGreater(statistics['create_queries'], 0)
+        self.assertIn('render:', send.statistics_summary)
+
+    @with_transaction()
+    def test_expression_cache(self):
+        'Test the compiled expressions are reused until the template changes'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+
+        template = create_template()
+        user, = create_users(1)
+        expression_cache.clear()
+
+        self.assertEqual(template.eval(template.subject, user),
+            'Hello User 0')
+        self.assertEqual(template.eval(template.subject, user),
+            'Hello User 0')
+        self.assertEqual(expression_cache.hits, 1)
+        self.assertEqual(expression_cache.misses, 1)
+
+        Template.write([template], {'subject': 'Bye ${record.name}'})
+        self.assertEqual(expression_cache.stats()['size'], 0)
+        template = Template(template.id)
+        self.assertEqual(template.eval(template.subject, user),
+            'Bye User 0')
+        self.assertEqual(expression_cache.misses, 2)
+
+    @with_transaction()
+    def test_static_expressions(self):
+        'Test the expressions without placeholders are rendered once'
+        users = create_users(2)
+        for engine in ['genshi', 'jinja2']:
+            template = create_template(engine=engine,
+                markdown='Your statement is ready.')
+            expression_cache.clear()
+            for user in users:
+                self.assertEqual(template.eval(template.markdown, user),
+                    'Your statement is ready.')
+                self.assertEqual(template.static_text(template.markdown, user),
+                    'Your statement is ready.')
+            self.assertEqual(expression_cache.misses, 1)
+
+        template = create_template(
+            subject='Hello ${record.name}, ${record.active} $$1')
+        self.assertIsNone(template.static_text(template.subject, users[0]))
+        self.assertEqual(template.eval(template.subject, users[0]),
+            'Hello User 0, True $1')
+        self.assertEqual(template.eval(template.subject, users[1]),
+            'Hello User 1, True $1')
+
+    @with_transaction()
+    def test_static_body(self):
+        'Test the body of a static markdown is rendered once'
+        pool = Pool()
+        Send = pool.get('electronic.mail.wizard.send')
+        Template = pool.get('electronic.mail.template')
+
+        users = create_users(2)
+        template = create_template(markdown='Your statement is ready.')
+        values = Send(use_tmpl_fields=True).get_values(template)
+        body_cache.clear()
+
+        messages = [Template.render(template, u, values) for u in users]
+        self.assertEqual([m['To'] for m in messages],
+            [u.email for u in users])
+        self.assertEqual(body_cache.misses, 1)
+        self.assertEqual(body_cache.hits, 1)
+
+        template = create_template()
+        values = Send(use_tmpl_fields=True).get_values(template)
+        Template.render(template, users[0], values)
+        self.assertEqual(body_cache.stats()['size'], 1)
+
+    @with_transaction()
+    def test_stored_attachments(self):
+        'Test the attachments are stored once and expanded when sent'
+        pool = Pool()
+        StoredAttachment = pool.get('electronic.mail.stored_attachment')
+        ElectronicEmail = pool.get('electronic.mail')
+
+        attachment = StoredAttachment.get_or_create(b'data')
+        self.assertEqual(StoredAttachment.get_or_create(b'data'), attachment)
+        self.assertEqual(attachment.size, 4)
+
+        message = MIMEMultipart()
+        message.attach(stored_attachment_part('test.txt', attachment.digest))
+        expanded = message_from_bytes(
+            ElectronicEmail.expand_stored_attachments(message.as_bytes()))
+        part, = expanded.get_payload()
+        self.assertEqual(part.get_filename(), 'test.txt')
+        self.assertEqual(part.get_payload(decode=True), b'data')
+
+        # the message sent is expanded without changing the stored one
+        sent = []
+        mail = ElectronicEmail(stored_attachments=[attachment],
+            mail_file=message.as_bytes())
+        server = Mock(send_message=lambda m, *a, **k: sent.append(m))
+        with pooled_smtp(prepare=ElectronicEmail.expand_stored_attachments), \
+                patch.object(smtp, '_get_smtp_server', return_value=server):
+            sendmail.send_message(message_from_bytes(mail.mail_file))
+        part, = sent[0].get_payload()
+        self.assertEqual(part.get_payload(decode=True), b'data')
+        self.assertEqual(bytes(mail.mail_file), message.as_bytes())
+
+        # the attachments of the sends are removed with their template
+        Template = pool.get('electronic.mail.template')
+        Send = pool.get('electronic.mail.wizard.send')
+        template = create_template()
+        Send.create([{
+                    'template': template.id,
+                    'attachments': [('create', [{
+                                    'name': 'test.txt',
+                                    'attachment': attachment.id,
+                                    }])],
+                    }])
+        Template.delete([template])
+        self.assertFalse(StoredAttachment.search([
+                    ('id', '=', attachment.id),
+                    ]))
+
+    @with_transaction()
+    def test_send_background(self):
+        'Test the background send tracks its progress'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Queue = pool.get('ir.queue')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        template = create_template()
+        users = create_users(10)
+
+        with patch.object(send_module, 'BATCH_SIZE', 3):
+            wizard = run_wizard(template, users, background=True)
+        send = wizard.start.send
+        self.assertEqual(send.total, len(users))
+        tasks = [t for t in Queue.search([])
+            if t.data['model'] == Send.__name__]
+        self.assertEqual(len(tasks), 4)
+        for task in tasks:
+            self.assertNotIn('active_ids', task.data['context'])
+        # the queue tasks are run without the language of the user
+        self.assertEqual(send.language, Transaction().context.get('language'))
+        with Transaction().set_context(language=None):
+            self.assertEqual(
+                list(send.group_by_language([u.id for u in users])),
+                [send.language])
+        self.assertEqual(send.rendered, 0)
+        self.assertEqual(send.state, 'running')
+
+        Send.process([send], [u.id for u in users], commit=True)
+        send = Send(send.id)
+        self.assertEqual(send.rendered, len(users))
+        self.assertEqual(send.failed, 0)
+        self.assertEqual(send.state, 'done')
+
+        # a task run again does not send the records already processed
+        Send.process([send], [u.id for u in users], commit=True)
+        send = Send(send.id)
+        self.assertEqual(send.rendered, len(users))
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            len(users))
+
+    @with_transaction()
+    def test_send_atomic(self):
+        'Test the send run by the wizard does not commit the transaction'
+        template = create_template()
+        users = create_users(10)
+
+        with patch.object(send_module, 'COMMIT_CHUNKS', True), \
+                patch.object(send_module, 'BATCH_SIZE', 2), \
+                patch.object(Transaction, 'commit') as commit:
+            run_wizard(template, users)
+        commit.assert_not_called()
+
+    @with_transaction()
+    def test_deduplicate(self):
+        'Test identical emails are sent once'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        template = create_template(
+            to='statements@example.com',
+            subject='Statement',
+            markdown='Your statement')
+        users = create_users(10)
+
+        run_wizard(template, users, deduplicate=True)
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            1)
+        send, = Send.search([('template', '=', template.id)])
+        self.assertEqual(send.rendered, 1)
+        self.assertEqual(send.merged, 9)
+        self.assertEqual(send.state, 'done')
+
+        # the duplicates of the other chunks are merged too
+        template = create_template(
+            to='statements@example.com',
+            subject='Statement',
+            markdown='Your statement')
+        with patch.object(send_module, 'BATCH_SIZE', 3):
+            run_wizard(template, users, deduplicate=True)
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            1)
+        send, = Send.search([('template', '=', template.id)])
+        self.assertEqual(send.merged, 9)
+
+    @with_transaction()
+    def test_failures(self):
+        'Test a failing record does not stop the send and can be retried'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Send = pool.get('electronic.mail.wizard.send')
+        User = pool.get('res.user')
+
+        template = create_template(subject='Hello ${record.email.upper()}')
+        users = create_users(9)
+        broken, = User.create([{
+                    'name': 'Broken',
+                    'login': 'broken',
+                    }])
+
+        run_wizard(template, users + [broken])
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            9)
+        send, = Send.search([('template', '=', template.id)])
+        self.assertEqual(send.rendered, 9)
+        self.assertEqual(send.failed, 1)
+        failure, = send.failures
+        self.assertEqual(failure.record_id, broken.id)
+        self.assertTrue(failure.error)
+
+        User.write([broken], {'email': 'broken@example.com'})
+        with patch.object(Send, 'enqueue', autospec=True) as enqueue:
+            Send.retry_failed([send])
+        enqueue.assert_called_once_with(send, [broken.id])
+        send = Send(send.id)
+        self.assertEqual(send.failed, 0)
+        self.assertEqual(send.failures, ())
+        self.assertEqual(send.state, 'running')
+
+        Send.process([send], [broken.id])
+        send = Send(send.id)
+        self.assertEqual(send.rendered, 10)
+        self.assertEqual(send.state, 'done')
+
+    def start_sink(self):
+        'Start a SMTP sink used as email uri until the end of the test'
+        sink = SMTPSink()
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+        self.addCleanup(sink.server_close)
+        self.addCleanup(sink.shutdown)
+        uri = config.get('email', 'uri')
+        config.set('email', 'uri',
+            'smtp://127.0.0.1:%s' % sink.server_address[1])
+        self.addCleanup(config.set, 'email', 'uri', uri)
+        return sink
+
+    def test_pooled_smtp(self):
+        'Test the messages reuse the SMTP connections at the rate'
+        sink = self.start_sink()
+
+        def send(count):
+            for i in range(count):
+                message = EmailMessage()
+                message['From'] = 'noreply@example.com'
+                message['To'] = 'user%s@example.com' % i
+                message['Message-ID'] = '<%s@example.com>' % i
+                message.set_content('Message %s' % i)
+                sendmail.send_message(message, strict=True)
+
+        with patch.object(smtp, 'MAX_PER_CONNECTION', 2), \
+                patch.object(smtp, 'RATE', 50):
+            start = time.monotonic()
+            with pooled_smtp():
+                send(5)
+            elapsed = time.monotonic() - start
+        self.assertEqual(sink.counters['messages'], 5)
+        self.assertEqual(sink.counters['connections'], 3)
+        self.assertGreaterEqual(elapsed, 4 / 50)
+
+        sink.reset()
+        send(2)
+        self.assertEqual(sink.counters['connections'], 2)
+
+    @with_transaction()
+    def test_pooled_smtp_send_mail(self):
+        'Test the electronic mails are sent through pooled connections'
+        ElectronicEmail = Pool().get('electronic.mail')
+
+        sink = self.start_sink()
+        template = create_template()
+        users = create_users(5)
+        run_wizard(template, users)
+        mails = ElectronicEmail.search([('template', '=', template.id)])
+        self.assertEqual(len(mails), len(users))
+
+        sink.reset()
+        with patch.object(smtp, 'MAX_PER_CONNECTION', 2):
+            ElectronicEmail._send_mail(mails)
+        self.assertEqual(sink.counters['messages'], len(users))
+        self.assertEqual(sink.counters['connections'], 3)
+
+    @with_transaction()
+    def test_send_domain(self):
+        'Test the records of a domain are streamed by pages'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        template = create_template()
+        users = create_users(10)
+        domain = [('login', 'like', 'user%')]
+
+        with patch.object(send_module, 'PAGE_SIZE', 3):
+            run_wizard(template, None, domain=domain)
+        send, = Send.search([('template', '=', template.id)])
+        self.assertEqual(send.total, len(users))
+        self.assertEqual(send.rendered, len(users))
+        self.assertEqual(send.state, 'done')
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            len(users))
+
+        with patch.object(send_module, 'PAGE_SIZE', 4):
+            self.assertEqual(list(send.stream_ids()),
+                sorted(u.id for u in users))
+
+    @with_transaction()
+    def test_send_domain_rules(self):
+        'Test the records of a domain are limited by the record rules'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        RuleGroup = pool.get('ir.rule.group')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        template = create_template()
+        users = create_users(10)
+        RuleGroup.create([{
+                    'name': "Not the first user",
+                    'model': 'res.user',
+                    'global_p': True,
+                    'perm_read': True,
+                    'perm_create': False,
+                    'perm_write': False,
+                    'perm_delete': False,
+                    'rules': [('create', [{
+                                    'domain': json.dumps(
+                                        [('login', '!=', users[0].login)]),
+                                    }])],
+                    }])
+
+        run_wizard(template, None, domain=[('login', 'like', 'user%')])
+        send, = Send.search([('template', '=', template.id)])
+        self.assertEqual(send.total, len(users) - 1)
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            len(users) - 1)
+
+    @with_transaction()
+    def test_send_domain_active_ids(self):
+        'Test the selected records are sent instead of the active domain'
+        pool = Pool()
+        ElectronicEmail = pool.get('electronic.mail')
+        Send = pool.get('electronic.mail.wizard.send')
+
+        template = create_template()
+        users = create_users(10)
+        domain = [('login', 'like', 'user%')]
+
+        run_wizard(template, users[:3], domain=domain)
+        send, = Send.search([('template', '=', template.id)])
+        self.assertFalse(send.domain)
+        self.assertEqual(send.total, 3)
+        self.assertEqual(
+            ElectronicEmail.search_count([('template', '=', template.id)]),
+            3)
+
+    @with_transaction()
+    def test_preview(self):
+        'Test the preview renders only the first records'
+        pool = Pool()
+        GenerateTemplateEmail = pool.get(
+            'electronic_mail_wizard.templateemail', type='wizard')
+
+        template = create_template()
+        users = create_users(10)
+
+        session_id, _, _ = GenerateTemplateEmail.create()
+        wizard = GenerateTemplateEmail(session_id)
+        with Transaction().set_context(
+                active_model='res.user',
+                active_ids=[u.id for u in users],
+                action_id=template.wizard.id), \
+                patch.object(electronic_mail_wizard, 'PREVIEW_SIZE', 3):
+            for name, value in wizard.render_fields(wizard.__name__).items():
+                setattr(wizard.start, name, value)
+            wizard.start.use_tmpl_fields = True
+            wizard.start.attachments = []
+            wizard.start.origin_attachments = []
+            wizard.start.deduplicate = False
+            wizard.start.merge_attachments = False
+            preview = wizard.default_preview([])
+
+        self.assertEqual(preview['total'], len(users))
+        self.assertEqual([p['subject'] for p in preview['previews']],
+            ['Hello %s' % u.name for u in users[:3]])
+        self.assertEqual(preview['previews'][0]['to'], users[0].email)
+        self.assertIn(users[0].login, preview['previews'][0]['body'])
+        self.assertGreater(preview['estimated_size'], 0)
+
+    @with_transaction()
+    def test_origin_attachments(self):
+        'Test the origin attachments are checked by size and sent'
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        ElectronicEmail = pool.get('electronic.mail')
+        Start = pool.get('electronic.mail.wizard.templateemail.start')
+
+        template = create_template()
+        user, = create_users(1)
+        attachment, = Attachment.create([{
+                    'name': 'test.txt',
+                    'resource': str(user),
+                    'data': b'data',
+                    }])
+        self.assertEqual(get_attachment_sizes([attachment.id]),
+            {attachment.id: 4})
+
+        run_wizard(template, [user], origin_attachments=[attachment])
+        mail, = ElectronicEmail.search([('template', '=', template.id)])
+
+        with patch.object(electronic_mail_wizard, 'MAX_ATTACHMENT_SIZE', 4):
+            with self.assertRaises(UserError):
+                run_wizard(template, [user], origin_attachments=[attachment])
+        with patch.object(electronic_mail_wizard, 'MAX_ATTACHMENTS_SIZE', 3):
+            with self.assertRaises(UserError):
+                run_wizard(template, [user], origin_attachments=[attachment])
+
+        start = Start(origin_attachments=[attachment])
+        self.assertEqual(start.on_change_with_origin_attachments_size(), 4)
+
+    @with_transaction()
+    def test_create_wizards(self):
+        'Test a wizard and its keyword are created for each template'
+        pool = Pool()
+        Keyword = pool.get('ir.action.keyword')
+
+        template = create_template()
+        other = create_template(name='Other', create_action=False)
+
+        self.assertEqual(template.wizard.name, template.name)
+        self.assertEqual(
+            template.wizard.wiz_name, 'electronic_mail_wizard.templateemail')
+        self.assertFalse(other.wizard)
+        keyword, = Keyword.search([
+                ('action', '=', template.wizard.action.id),
+                ])
+        self.assertEqual(keyword.keyword, 'form_action')
+        self.assertEqual(keyword.model, 'res.user,-1')
+
+    @with_transaction()
+    def test_write_wizards(self):
+        'Test the wizards follow the changes of the templates'
+        pool = Pool()
+        Keyword = pool.get('ir.action.keyword')
+        Template = pool.get('electronic.mail.template')
+        Wizard = pool.get('ir.action.wizard')
+
+        template = create_template()
+        wizard = template.wizard
+
+        Template.write([template], {'name': 'Renamed'})
+        self.assertEqual(Wizard(wizard.id).name, 'Renamed')
+
+        Template.write([template], {'create_action': True})
+        self.assertEqual(Template(template.id).wizard, wizard)
+
+        action = wizard.action.id
+        Template.write([template], {'create_action': False})
+        self.assertFalse(Template(template.id).wizard)
+        self.assertFalse(Wizard.search([('id', '=', wizard.id)]))
+        self.assertFalse(Keyword.search([('action', '=', action)]))
+
 
 del ModuleTestCase